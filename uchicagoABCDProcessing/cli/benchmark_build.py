@@ -0,0 +1,124 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Benchmark of the workflow graph build.
+
+Times ``init_base_wf`` on a synthetic participant with an increasing number of functional
+runs, the time per run should stay flat as the runs are added::
+
+    python -m uchicagoABCDProcessing.cli.benchmark_build --runs 1 2 4 8 16
+
+The images are tiny, only the graph is built, nothing is run.
+"""
+
+import json
+import logging
+import tempfile
+from argparse import ArgumentParser
+from argparse import ArgumentDefaultsHelpFormatter
+from collections import OrderedDict
+from pathlib import Path
+from time import time
+
+logger = logging.getLogger('cli')
+
+PARTICIPANT = 'bench'
+TASKS = ('rest', 'MID', 'SST', 'nback')
+
+
+def get_parser():
+    """Build parser object"""
+    parser = ArgumentParser(description='Time the workflow graph build against the number of '
+                                        'functional runs',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--runs', action='store', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help='numbers of functional runs to build the graph of')
+    parser.add_argument('--repeats', action='store', type=int, default=3,
+                        help='builds per number of runs, the fastest is kept')
+    parser.add_argument('--parcellations', action='store', nargs='+', default=['shen_268'],
+                        help='parcellations of the built graph')
+    parser.add_argument('--work_dir', action='store', type=Path, default=None,
+                        help='directory of the synthetic datasets (a temporary one by default)')
+    parser.add_argument('--output', action='store', type=Path, default=None,
+                        help='JSON file the timings are written to')
+    return parser
+
+
+def write_dataset(bids_dir, n_runs, session='ses-baselineYear1Arm1'):
+    """A BIDS dataset of one participant with a T1w image and ``n_runs`` bold runs"""
+    import nibabel
+    import numpy
+
+    bids_dir = Path(bids_dir)
+    bids_dir.mkdir(parents=True, exist_ok=True)
+    (bids_dir / 'dataset_description.json').write_text(json.dumps(
+        {'Name': 'graph build benchmark', 'BIDSVersion': '1.1.1'}))
+    subject_dir = bids_dir / ('sub-%s' % PARTICIPANT) / session
+    prefix = 'sub-%s_%s' % (PARTICIPANT, session)
+    affine = numpy.diag([2.4, 2.4, 2.4, 1])
+
+    (subject_dir / 'anat').mkdir(parents=True, exist_ok=True)
+    nibabel.Nifti1Image(numpy.zeros((16, 16, 16), dtype=numpy.int16), affine).to_filename(
+        str(subject_dir / 'anat' / ('%s_T1w.nii.gz' % prefix)))
+
+    (subject_dir / 'func').mkdir(parents=True, exist_ok=True)
+    for index in range(n_runs):
+        task = TASKS[index % len(TASKS)]
+        name = '%s_task-%s_run-%02d_bold' % (prefix, task, index // len(TASKS) + 1)
+        img = nibabel.Nifti1Image(numpy.zeros((16, 16, 16, 10), dtype=numpy.int16), affine)
+        img.header.set_xyzt_units('mm', 'sec')
+        img.header.set_zooms((2.4, 2.4, 2.4, 0.8))
+        img.to_filename(str(subject_dir / 'func' / ('%s.nii.gz' % name)))
+        (subject_dir / 'func' / ('%s.json' % name)).write_text(json.dumps(
+            {'RepetitionTime': 0.8, 'TaskName': task}))
+    return bids_dir
+
+
+def time_build(root, n_runs, repeats=3, parcellations=('shen_268',)):
+    """Fastest of ``repeats`` builds of the graph of ``n_runs`` runs, in seconds"""
+    import re
+    from bids import BIDSLayout
+    from niworkflows.utils.bids import collect_participants
+    from .build_workflow import init_workflow
+    from .run_utils import get_parser as get_run_parser
+
+    root = Path(root) / ('runs-%d' % n_runs)
+    bids_dir = write_dataset(root / 'bids', n_runs)
+    opts = get_run_parser().parse_args([
+        str(bids_dir), str(root / 'output'), 'participant', '--parcellations'] +
+        list(parcellations) + ['--participant_label', PARTICIPANT, '-w', str(root / 'work'),
+                               '--notrack', '--no_workflow_cache'])
+    layout = BIDSLayout(str(bids_dir), validate=False, ignore=(re.compile(r'^\.'),))
+    subject_list = collect_participants(layout, participant_label=opts.participant_label)
+    output_spaces = opts.output_spaces or OrderedDict([('MNI152NLin2009cAsym', {})])
+
+    timings = []
+    for _ in range(max(1, repeats)):
+        start = time()
+        init_workflow(opts, layout, subject_list, output_spaces, 1, root / 'output',
+                      root / 'work', 'benchmark')
+        timings.append(time() - start)
+    return min(timings)
+
+
+def main():
+    """Entry point"""
+    opts = get_parser().parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = opts.work_dir or Path(tmp)
+        results = []
+        for n_runs in sorted(set(opts.runs)):
+            seconds = time_build(root, n_runs, opts.repeats, opts.parcellations)
+            results.append({'runs': n_runs, 'seconds': seconds,
+                            'seconds_per_run': seconds / n_runs})
+            logger.info('%3d runs: %7.2f s (%.3f s per run)', n_runs, seconds, seconds / n_runs)
+
+    if opts.output is not None:
+        opts.output.write_text(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    main()
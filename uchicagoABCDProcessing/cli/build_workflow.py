@@ -11,9 +11,10 @@ def build_workflow(opts, retval):
     from niworkflows.utils.bids import collect_participants
     from niworkflows.reports import generate_reports
     from ..__about__ import __version__
-    from time import strftime
+    from time import strftime, time
     import uuid
-    from ..workflows.base import init_base_wf
+    from ..utils.workflow_cache import (workflow_cache_key, workflow_roots, load_workflow,
+                                         save_workflow)
 
     build_log = nlogging.getLogger('nipype.workflow')
 
@@ -29,6 +30,10 @@ def build_workflow(opts, retval):
     bids_dir = opts.bids_dir.resolve()
     output_dir = opts.output_dir.resolve()
     work_dir = opts.work_dir.resolve()
+    # the graph only holds absolute paths, so a cached copy can be moved to other directories
+    opts.bids_dir, opts.output_dir, opts.work_dir = bids_dir, output_dir, work_dir
+    if opts.cold_output_dir is not None:
+        opts.cold_output_dir = opts.cold_output_dir.resolve()
 
     retval['return_code'] = 1
     retval['workflow'] = None
@@ -144,7 +149,55 @@ def build_workflow(opts, retval):
         uuid=run_uuid)
                   )
 
-    retval['workflow'] = retval['workflow'] = init_base_wf(
+    cache_key = None
+    cache_dir = opts.workflow_cache_dir or work_dir / 'workflow_cache'
+    if not opts.no_workflow_cache:
+        cache_key = workflow_cache_key(opts, bids_dir, subject_list, cache_dir=cache_dir)
+        retval['workflow'] = load_workflow(cache_dir, cache_key, roots=workflow_roots(opts),
+                                           run_uuid=run_uuid)
+        if retval['workflow'] is not None:
+            build_log.log(25, 'Loaded the workflow from %s', cache_dir)
+
+    if retval['workflow'] is None:
+        start = time()
+        retval['workflow'] = init_workflow(opts, layout, subject_list, output_spaces,
+                                           omp_nthreads, output_dir, work_dir, run_uuid)
+        build_log.log(25, 'Built the workflow of %d participant(s) in %.1f s',
+                      len(subject_list), time() - start)
+        if cache_key is not None:
+            save_workflow(cache_dir, cache_key, run_uuid, retval['workflow'],
+                          roots=workflow_roots(opts))
+    retval['return_code'] = 0
+
+    logs_path = Path(output_dir) / 'uchicagoABCDProcessing' / 'logs'
+    boilerplate = retval['workflow'].visit_desc()
+
+    if boilerplate:
+        citation_files = {
+            ext: logs_path / ('CITATION.%s' % ext)
+            for ext in ('bib', 'tex', 'md', 'html')
+        }
+        # To please git-annex users and also to guarantee consistency
+        # among different renderings of the same file, first remove any
+        # existing one
+        for citation_file in citation_files.values():
+            try:
+                citation_file.unlink()
+            except FileNotFoundError:
+                pass
+
+        citation_files['md'].write_text(boilerplate)
+        build_log.log(25, 'Works derived from this uchicagoABCDProcessing execution should '
+                          'include the following boilerplate:\n\n%s', boilerplate)
+    return retval
+
+
+def init_workflow(opts, layout, subject_list, output_spaces, omp_nthreads, output_dir, work_dir,
+                  run_uuid):
+    """The :func:`..workflows.base.init_base_wf` graph of the parsed command line ``opts``"""
+    from ..workflows.base import init_base_wf
+
+    return init_base_wf(
         anat_only=opts.anat_only,
         aroma_melodic_dim=opts.aroma_melodic_dimensionality,
         bold2t1w_dof=opts.bold2t1w_dof,
@@ -181,26 +234,3 @@ def build_workflow(opts, retval):
         work_dir=str(work_dir),
         opts=opts
     )
-    retval['return_code'] = 0
-
-    logs_path = Path(output_dir) / 'uchicagoABCDProcessing' / 'logs'
-    boilerplate = retval['workflow'].visit_desc()
-
-    if boilerplate:
-        citation_files = {
-            ext: logs_path / ('CITATION.%s' % ext)
-            for ext in ('bib', 'tex', 'md', 'html')
-        }
-        # To please git-annex users and also to guarantee consistency
-        # among different renderings of the same file, first remove any
-        # existing one
-        for citation_file in citation_files.values():
-            try:
-                citation_file.unlink()
-            except FileNotFoundError:
-                pass
-
-        citation_files['md'].write_text(boilerplate)
-        build_log.log(25, 'Works derived from this uchicagoABCDProcessing execution should '
-                          'include the following boilerplate:\n\n%s', boilerplate)
-    return retval
@@ -17,16 +17,176 @@ logger = logging.getLogger('cli')
 
 def main():
     """Entry point"""
-    from .run_utils import get_workflow
-    import sentry_sdk
-    from ..utils.bids import write_derivative_description
+    from copy import copy
+    from .run_utils import (get_opts, remove_staged, scratch_footprint, stage_participant,
+                            subject_paths)
+    from ..utils.prefetch import PrefetchQueue
+    from ..utils.run_report import RunReport
     if __name__ == 'main':
         set_start_method('forkserver')
+    opts, exec_env = get_opts()
+
+    admission = None
+    scratch_admission = None
+    if opts.disk_admission:
+        from ..utils.disk_space import DiskAdmission, same_filesystem
+        opts.work_dir.mkdir(parents=True, exist_ok=True)
+        admission = DiskAdmission(opts.work_dir,
+                                  headroom_bytes=int(opts.disk_headroom_gb * 1024 ** 3),
+                                  evict=opts.evict_completed, timeout=opts.disk_wait_timeout)
+        if opts.scratch_dir is not None:
+            opts.scratch_dir.mkdir(parents=True, exist_ok=True)
+            if not same_filesystem(opts.scratch_dir, opts.work_dir):
+                # the workflows run on another filesystem, which gets its own admission
+                scratch_admission = DiskAdmission(
+                    opts.scratch_dir, headroom_bytes=int(opts.disk_headroom_gb * 1024 ** 3),
+                    timeout=opts.disk_wait_timeout)
+
+    reports = {participant: RunReport(participant) for participant in opts.participant_label}
+    failed = []
+
+    def _stage(participant):
+        if opts.skip_download:
+            return 0
+        try:
+            return stage_participant(opts, participant, admission=admission,
+                                     report=reports[participant])
+        except Exception:
+            if admission is not None:
+                admission.complete(participant)
+            raise
+
+    def _run_batch(batch):
+        participant_opts = copy(opts)
+        participant_opts.participant_label = batch
+        staging = [reports.pop(member) for member in batch]
+        report = staging[0]
+        if len(batch) > 1:
+            report = RunReport('+'.join(batch))
+            for participant_report in staging:
+                report.merge(participant_report)
+        try:
+            if opts.scratch_dir is not None:
+                label = '+'.join(batch)
+                if scratch_admission is not None:
+                    with report.timer('disk_admission'):
+                        scratch_admission.admit(label, scratch_footprint(opts, batch))
+                try:
+                    run_in_scratch(participant_opts, exec_env, report=report)
+                finally:
+                    if scratch_admission is not None:
+                        scratch_admission.complete(label)
+            else:
+                run_participant(participant_opts, exec_env, report=report)
+        except SystemExit as e:
+            if not e.code:  # --reports-only, --boilerplate
+                raise
+            logger.error('The workflow of %s failed (exit code %s)', ', '.join(batch), e.code)
+            failed.extend(batch)
+        except Exception as e:
+            logger.error('The workflow of %s failed: %s', ', '.join(batch), e)
+            failed.extend(batch)
+        else:
+            if not opts.skip_download and not opts.keep_staged:
+                # the inputs of a completed participant are not needed anymore, the ones of a
+                # failed participant are kept to look into
+                for participant in batch:
+                    remove_staged(opts, participant)
+        finally:
+            if admission is not None:
+                for participant in batch:
+                    admission.complete(participant, paths=subject_paths(opts, participant))
+
+    # stage upcoming participants in the background while the current workflow runs
+    max_bytes = None if opts.prefetch_gb is None else int(opts.prefetch_gb * 1024 ** 3)
+    prefetch = PrefetchQueue(_stage, opts.participant_label, max_items=opts.prefetch_subjects,
+                             max_bytes=max_bytes,
+                             stalled=admission.holding if admission is not None else None)
+    # staged participants are run --subjects_per_graph at a time in a single workflow, fewer
+    # when the next ones can not be staged before these complete, the ones that could not be
+    # staged are skipped
+    for batch in prefetch.batches(opts.subjects_per_graph):
+        _run_batch(batch)
+    if prefetch.failed:
+        logger.error('Could not stage %d of %d participants: %s', len(prefetch.failed),
+                     len(opts.participant_label),
+                     ', '.join(participant for participant, _ in prefetch.failed))
+    if failed:
+        logger.error('Could not process %d of %d participants: %s', len(failed),
+                     len(opts.participant_label), ', '.join(failed))
+    if prefetch.failed or failed:
+        sys.exit(1)
+
+
+def run_in_scratch(opts, exec_env, report=None):
+    """
+    Run staged participants in a directory under ``--scratch_dir`` (node-local SSD or tmpfs):
+    their BIDS data is copied in, the workflow works and writes there, and the derivatives are
+    copied back to ``output_dir`` and ``cold_output_dir`` in bulk. Only the logs are copied back
+    when the run fails. The scratch directory is always removed. The run report is written again
+    once the derivatives are copied back, to include that copy.
+    """
+    import time
+    from copy import copy
+    from pathlib import Path
+    from .run_utils import write_run_report
+    from ..utils.scratch import scratch_dir, copy_tree
+
+    bids_dir = Path(opts.work_dir) / 'bids'
+    with scratch_dir(opts.scratch_dir) as scratch:
+        scratch_opts = copy(opts)
+        scratch_opts.work_dir = scratch / 'work'
+        # cached workflows outlive the scratch directory
+        if opts.workflow_cache_dir is None:
+            scratch_opts.workflow_cache_dir = Path(opts.work_dir) / 'workflow_cache'
+        scratch_opts.output_dir = scratch / 'output'
+        if opts.cold_output_dir is not None:
+            scratch_opts.cold_output_dir = scratch / 'cold_output'
+
+        start = time.time()
+        n_bytes = 0
+        for path in bids_dir.iterdir():
+            if path.is_file():  # dataset_description.json & co
+                n_bytes += copy_tree(path, scratch_opts.work_dir / 'bids' / path.name)
+        for participant in opts.participant_label:
+            subject = 'sub-%s' % participant.replace('_', '')
+            n_bytes += copy_tree(bids_dir / subject, scratch_opts.work_dir / 'bids' / subject)
+        if report is not None:
+            report.add('scratch_stage_in', seconds=time.time() - start, nbytes=n_bytes)
+
+        try:
+            run_uuid = run_participant(scratch_opts, exec_env, report=report)
+        except BaseException:
+            copy_tree(scratch_opts.output_dir / 'uchicagoABCDProcessing' / 'logs',
+                      Path(opts.output_dir) / 'uchicagoABCDProcessing' / 'logs')
+            raise
+        start = time.time()
+        n_bytes = copy_tree(scratch_opts.output_dir, opts.output_dir)
+        if opts.cold_output_dir is not None:
+            n_bytes += copy_tree(scratch_opts.cold_output_dir, opts.cold_output_dir)
+        if report is not None:
+            report.add('scratch_stage_out', seconds=time.time() - start, nbytes=n_bytes)
+            write_run_report(report, opts.output_dir, run_uuid)
+
+
+def run_participant(opts, exec_env, report=None):
+    """
+    Build and run the workflow of already staged participants. The time spent in every step is
+    saved to a JSON report next to the nipype logs. Returns the UUID of the run.
+    """
+    from .run_utils import get_workflow, write_run_report
+    import sentry_sdk
+    from ..utils.bids import write_derivative_description
+    from ..utils.run_report import RunReport
     errno = 1  # Default is error exit unless otherwise set
-    workflow, plugin_settings, opts, output_dir, work_dir, bids_dir, subject_list, run_uuid = get_workflow(logger)
+    if report is None:
+        report = RunReport('+'.join(opts.participant_label))
+    workflow, plugin_settings, opts, output_dir, work_dir, bids_dir, subject_list, run_uuid = get_workflow(
+        logger, opts, exec_env, stage=False, report=report)
 
     try:
-        workflow.run(**plugin_settings)
+        with report.timer('workflow'):
+            workflow.run(**plugin_settings)
     except Exception as e:
         if not opts.notrack:
             from ..utils.sentry import process_crashfile
@@ -46,6 +206,9 @@ def main():
         if not opts.notrack:
             sentry_sdk.capture_message('uchicagoABCDProcessing finished without errors',
                                        level='info')
+    finally:
+        write_run_report(report, output_dir, run_uuid)
+    return run_uuid
     # finally:
     #     from niworkflows.reports import generate_reports
     #     from subprocess import check_call, CalledProcessError, TimeoutExpired
@@ -1,5 +1,7 @@
 import glob
 import os
+import shutil
+import tempfile
 from pathlib import Path
 import logging
 import sys
@@ -71,6 +73,15 @@ def get_parser() -> ArgumentParser():
                         help='craddock parcellation similarity_measure', )
     parser.add_argument('--algorithm', action='store', default='2level', choices=['2level', 'mean', None],
                         help='craddock parcellation algorithm', )
+    parser.add_argument('--atlas_dir', action='store', type=Path,
+                        help='folder of label images named after the parcellations (e.g. '
+                             'shen_268.nii.gz) in the output space. When given, the time series '
+                             'of all the parcellations are extracted in a single pass over the '
+                             'bold. Not compatible with --resolution, --similarity_measure and '
+                             '--algorithm')
+    parser.add_argument('--fused_postproc', action='store_true', default=False,
+                        help='trim the parcellated time series and compute their connectivity and '
+                             'dfa hurst exponents in a single node instead of three')
     parser.add_argument('--cold_output_dir', action='store', type=Path,
                         help='the output path for the outcomes of preprocessing and visual '
                              'reports')
@@ -89,8 +100,59 @@ def get_parser() -> ArgumentParser():
                         choices=['ses-baselineYear1Arm1'],
                         help='which session')
 
+    parser.add_argument('--manifest', action='store', type=Path, default=None,
+                        help='SQLite manifest of FMRIRESULTS01 (see uchicagoABCDProcessing-sync-manifest) '
+                             'the subject files are looked up in')
     parser.add_argument('--skip_download', action='store', type=bool, default=False,
                         help='skip downloading subject data')
+    parser.add_argument('--nda_token_cache', action='store', type=Path, default=None,
+                        help='file where NDA credentials are cached and shared between runs')
+    parser.add_argument('--download_nprocs', action='store', type=int, default=4,
+                        help='maximum number of concurrent S3 transfers')
+    parser.add_argument('--download_retries', action='store', type=int, default=5,
+                        help='number of times a failed S3 transfer is retried')
+    parser.add_argument('--download_range_threshold', action='store', type=float, default=512,
+                        help='archives of at least this size (in MB) are fetched as concurrent '
+                             'byte ranges, 0 keeps every archive on a single stream')
+    parser.add_argument('--download_range_nprocs', action='store', type=int, default=4,
+                        help='number of concurrent byte ranges per large archive')
+    parser.add_argument('--download_all_archives', action='store_true', default=False,
+                        help='fetch every archive of the subject instead of only the T1 and the '
+                             'requested task runs, duplicates included')
+    parser.add_argument('--stream_extract', action='store_true', default=False,
+                        help='extract archives while they download instead of storing the tgz files')
+    parser.add_argument('--extract_exclude', action='store', nargs='+', default=[],
+                        help='archive members matching these patterns are not extracted')
+    parser.add_argument('--download_cache_dir', action='store', type=Path, default=None,
+                        help='directory of a download cache shared across subjects and runs')
+    parser.add_argument('--download_cache_quota', action='store', type=float, default=100,
+                        help='size (in GB) the download cache is kept under')
+    parser.add_argument('--subjects_per_graph', action='store', type=int, default=1,
+                        help='number of participants processed together in one workflow graph')
+    parser.add_argument('--prefetch_subjects', action='store', type=int, default=1,
+                        help='number of participants staged in the background while the current '
+                             'one is processed')
+    parser.add_argument('--prefetch_gb', action='store', type=float, default=None,
+                        help='no further participant is staged while the staged data exceeds '
+                             'this size (in GB)')
+    parser.add_argument('--s3_endpoint_url', action='store', type=str, default=None,
+                        help='alternative S3 endpoint (e.g. a local test server)')
+    parser.add_argument('--scratch_dir', action='store', type=Path, default=None,
+                        help='node-local directory (SSD or tmpfs) each participant is processed '
+                             'in, only the derivatives are copied back to the output dirs')
+    parser.add_argument('--disk_admission', action='store_true', default=False,
+                        help='hold participants until the work dir (and --scratch_dir) has room '
+                             'for their estimated footprint')
+    parser.add_argument('--disk_headroom_gb', action='store', type=float, default=10,
+                        help='space (in GB) kept free in the work dir on top of the estimates')
+    parser.add_argument('--disk_wait_timeout', action='store', type=float, default=None,
+                        help='seconds a participant waits for space before the run fails')
+    parser.add_argument('--evict_completed', action='store_true', default=False,
+                        help='delete the staged data and work dir of completed participants '
+                             'when space is needed')
+    parser.add_argument('--keep_staged', action='store_true', default=False,
+                        help='keep the staged BIDS data and downloaded archives of participants '
+                             'whose workflow completed, they are deleted by default')
 
     # optional arguments
     parser.add_argument('--version', action='version', version=verstr)
@@ -297,6 +359,15 @@ For further details, please check out \
              'No effect without --reports-only.')
     g_other.add_argument('--write-graph', action='store_true', default=False,
                          help='Write workflow graph.')
+    g_other.add_argument('--no_workflow_cache', '--no-workflow-cache', action='store_true',
+                         default=False,
+                         help='always rebuild the workflow instead of loading the copy cached in '
+                              'the work directory by a previous run with the same options, '
+                              'packages and input files')
+    g_other.add_argument('--workflow_cache_dir', action='store', type=Path, default=None,
+                         help='directory of the cached workflows (default: workflow_cache in the '
+                              'work directory, outside of the scratch directory with '
+                              '--scratch_dir)')
     g_other.add_argument('--stop-on-first-crash', action='store_true', default=False,
                          help='Force stopping on first crash, even if a work directory'
                               ' was specified.')
@@ -328,15 +399,24 @@ discourage its usage.""" % (__version__, _reason), file=sys.stderr)
     return parser
 
 
-def get_workflow(logger):
-    from nipype import logging as nlogging
-    from multiprocessing import set_start_method, Process, Manager
-    from ..utils.bids import validate_input_dir
-    from .build_workflow import build_workflow
-    if __name__ == 'main':
-        set_start_method('forkserver')
+def get_opts():
+    """Parse the command line and set up tracking"""
     # warnings.showwarning = _warn_redirect
-    opts = get_parser().parse_args()
+    parser = get_parser()
+    opts = parser.parse_args()
+    if opts.task_id is not None:
+        # the archives, their members and fmriprep's task filter all use the BIDS label
+        from ..utils.download_plan import bids_task
+        try:
+            opts.task_id = bids_task(opts.task_id)
+        except ValueError as e:
+            parser.error(str(e))
+    if opts.atlas_dir is not None:
+        # the label images replace the atlasTransform parcellation and its options
+        ignored = ['--%s' % name for name in ('resolution', 'similarity_measure', 'algorithm')
+                   if getattr(opts, name) != parser.get_default(name)]
+        if ignored:
+            parser.error('%s can not be used with --atlas_dir' % ', '.join(ignored))
 
     exec_env = os.name
 
@@ -349,115 +429,326 @@ def get_workflow(logger):
     #         if os.getenv('DOCKER_VERSION_8395080871'):
     #             exec_env = 'fmriprep-docker'
 
-    sentry_sdk = None
     if not opts.notrack:
-        import sentry_sdk
         from ..utils.sentry import sentry_setup
         sentry_setup(opts, exec_env)
 
+    return opts, exec_env
+
+
+# archives of the only subject the pipeline was developed on, used when no manifest is given
+DEVELOPMENT_SUBJECT = 'NDARINVRCE62M22'
+
+
+def get_subject_files(opts, participant):
+    """
+    S3 urls of the anatomical and functional archives of ``participant``, from ``--manifest``.
+    Without a manifest only the development subject is known.
+    """
+    if opts.manifest is not None:
+        from ..utils.manifest import Manifest
+        subject_files = Manifest(opts.manifest).subject_files(participant)
+        if not subject_files:
+            raise RuntimeError('No files for participant %s in the manifest %s' % (
+                participant, opts.manifest))
+        return subject_files
+
+    # get_files = OracleQuery()
+    # get_files.inputs.username = opts.miNDAR_username
+    # get_files.inputs.password = opts.miNDAR_password
+    # get_files.inputs.host = opts.miNDAR_host
+    # get_files.inputs.service = 'ORCL'
+    # get_files.inputs.write_to_file=False
+    #
+    # get_files.inputs.query = "select column_name from USER_TAB_COLUMNS where table_name = 'FMRIRESULTS01'"
+    # get_files.run()
+    # columns = get_files._results['out'].values.flatten()
+    # scan_type = numpy.argwhere(columns == 'SCAN_TYPE').flatten()[0]
+    # file_link = numpy.argwhere(columns == 'DERIVED_FILES').flatten()[0]
+    #
+    # get_files.inputs.query = "select * from FMRIRESULTS01 where SUBJECTKEY = '%s'" % participant
+    # get_files.run()
+    # subject_files = get_files._results['out']
+    #
+    # anat_and_func_files =subject_files[(subject_files[scan_type] =='MR structural (T1)') | (subject_files[scan_type] =='fMRI')][file_link].values
+    if participant.replace('_', '') != DEVELOPMENT_SUBJECT:
+        raise RuntimeError('No archive list for participant %s, give a --manifest of '
+                           'FMRIRESULTS01' % participant)
+    return ['s3://NDAR_Central_2/submission_19161/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414114436.tgz',
+            's3://NDAR_Central_2/submission_19161/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414120922.tgz',
+            's3://NDAR_Central_2/submission_19161/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414121456.tgz',
+            's3://NDAR_Central_2/submission_19161/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414113822.tgz',
+            's3://NDAR_Central_2/submission_19137/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-MID-fMRI_20170414123932.tgz',
+            's3://NDAR_Central_2/submission_19137/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-MID-fMRI_20170414123343.tgz',
+            # 's3://NDAR_Central_2/submission_19137/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-T1_20170414113634.tgz',
+            's3://NDAR_Central_3/submission_19178/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-SST-fMRI_20170414125453.tgz',
+            's3://NDAR_Central_3/submission_19178/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-nBack-fMRI_20170414122216.tgz',
+            's3://NDAR_Central_3/submission_19178/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-SST-fMRI_20170414124837.tgz',
+            's3://NDAR_Central_3/submission_19178/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-nBack-fMRI_20170414122744.tgz'
+            ]
+
+
+def stage_participant(opts, participant, admission=None, report=None):
+    """
+    Download, extract and deface the data of ``participant`` into ``work_dir/bids``. The subject
+    is assembled in a private directory under ``work_dir/staging`` and moved into the BIDS tree
+    with a single rename once complete, so workflows reading ``work_dir/bids`` meanwhile never
+    see it half written. Returns the number of bytes staged for the subject. When a
+    :class:`..utils.disk_space.DiskAdmission` is given nothing is transferred until it admits
+    the subject. The time and bytes of every step are recorded in ``report`` (a
+    :class:`..utils.run_report.RunReport`).
+    """
+    from ..utils.download import get_s3_client
+    from ..utils.download_cache import DownloadCache
+    from ..utils.nda_token import NDATokenProvider
+    from ..utils.download_plan import plan_downloads
+    from ..utils.run_report import RunReport
+
+    if report is None:
+        report = RunReport(participant)
+    bids_dir = os.path.join(opts.work_dir, 'bids')
+    token_provider = NDATokenProvider(opts.nda_username, opts.nda_password,
+                                      cache_file=opts.nda_token_cache)
+    anat_and_func_files = get_subject_files(opts, participant)
+
+    download_dir = os.path.join(opts.work_dir,'downloads')
+    s3_client = get_s3_client(token_provider,
+                              endpoint_url=opts.s3_endpoint_url,
+                              max_connections=opts.download_nprocs * max(
+                                  1, opts.download_range_nprocs))
+    sizes = None
+    if opts.manifest is not None:
+        from ..utils.manifest import Manifest
+        sizes = {url: size for url, size, _ in
+                 Manifest(opts.manifest).subject_objects(participant)}
+    with report.timer('plan'):
+        plan = plan_downloads(anat_and_func_files, session=opts.session, task_id=opts.task_id,
+                              sizes=sizes, s3_client=s3_client, n_procs=opts.download_nprocs,
+                              select=not opts.download_all_archives)
+    anat_and_func_files = plan.urls
+    if admission is not None:
+        with report.timer('disk_admission'):
+            admission.admit(participant, admission_footprint(opts, plan.n_bytes))
+
+    download_cache = None
+    if opts.download_cache_dir is not None:
+        download_cache = DownloadCache(opts.download_cache_dir,
+                                       quota_bytes=int(opts.download_cache_quota * 1024 ** 3))
+
+    subject = 'sub-%s' % participant.replace('_','')
+    subject_dir = os.path.join(bids_dir, subject)
+    os.makedirs(bids_dir, exist_ok=True)
+    os.makedirs(os.path.join(opts.work_dir, 'staging'), exist_ok=True)
+    stage_dir = tempfile.mkdtemp(prefix=subject + '.', dir=os.path.join(opts.work_dir, 'staging'))
+    previous_dir = os.path.join(stage_dir, subject)
+    try:
+        if os.path.isdir(subject_dir):
+            # restage on top of what a previous staging of the subject left
+            os.replace(subject_dir, previous_dir)
+        _stage_subject(opts, participant, stage_dir, anat_and_func_files, plan, s3_client,
+                       download_dir, download_cache, admission, report)
+        _publish(stage_dir, bids_dir)
+    except BaseException:
+        if os.path.isdir(previous_dir) and not os.path.exists(subject_dir):
+            # give back the previously published subject rather than delete it with the
+            # staging dir
+            os.replace(previous_dir, subject_dir)
+        raise
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+    staged = _dir_size(subject_dir)
+    if admission is not None:
+        # measured once, what the workflow writes next stays held back until it completes
+        admission.update(participant, written=staged + sum(
+            path.stat().st_size for path in subject_paths(opts, participant)
+            if path.is_file()))
+    return staged
+
+
+def _stage_subject(opts, participant, stage_dir, anat_and_func_files, plan, s3_client,
+                   download_dir, download_cache, admission, report):
+    """Extract and deface the archives of ``participant`` into the BIDS tree ``stage_dir``"""
+    from multiprocessing import cpu_count
+    from ..utils.download import download_objects, stream_extract_objects
+    from ..utils.archives import member_patterns, extract_archives
+    from ..utils.deface import deface_images
+
+    session_dir = os.path.join(stage_dir, 'sub-%s' % participant.replace('_',''), opts.session)
+    func_dir = os.path.join(session_dir,'func')
+    anat_dir = os.path.join(session_dir, 'anat')
+
+    os.makedirs(func_dir, exist_ok=True)
+    os.makedirs(anat_dir, exist_ok=True)
+
+    # only the members init_base_wf reads for the requested session/task are extracted
+    include = member_patterns(opts.session, task_id=opts.task_id, ignore=opts.ignore)
+
+    if opts.stream_extract:
+        # decompress the archives as they arrive, the tgz files are never stored
+        with report.timer('stream_extract'):
+            stream_extract_objects(s3_client, anat_and_func_files, stage_dir,
+                                   include=include, exclude=opts.extract_exclude,
+                                   n_procs=opts.download_nprocs,
+                                   retries=opts.download_retries, cache=download_cache,
+                                   report=report)
+        # the bytes streamed from S3 are added per archive, cached archives move none
+        report.add('stream_extract', count=len(anat_and_func_files))
+    else:
+        with report.timer('download'):
+            downloaded_files = download_objects(s3_client, anat_and_func_files, download_dir,
+                                                n_procs=opts.download_nprocs,
+                                                retries=opts.download_retries,
+                                                cache=download_cache,
+                                                report=report,
+                                                range_threshold=int(
+                                                    opts.download_range_threshold * 1024 ** 2),
+                                                range_nprocs=opts.download_range_nprocs
+                                                )  # download all the files
+        # the bytes fetched from S3 are added per object, local and cached copies move none
+        report.add('download', count=len(downloaded_files))
+
+        with report.timer('extract'):
+            timings = extract_archives(downloaded_files, stage_dir, include=include,
+                                       exclude=opts.extract_exclude,
+                                       n_procs=opts.nthreads)  # untar files
+        for timing in timings:
+            report.record('extract', timing['archive'], timing['seconds'], timing['bytes'],
+                          members=timing['members'])
+        report.add('extract', nbytes=sum(timing['bytes'] for timing in timings),
+                   count=len(timings))
+    if admission is not None:
+        # the BOLD headers give a better estimate of the work dir than the archive sizes
+        bold_files = glob.glob(os.path.join(func_dir, '*_bold.nii*'))
+        admission.update(participant, admission_footprint(opts, plan.n_bytes, bold_files))
+    t1_files = glob.glob(os.path.join(anat_dir, "*T1w.nii"))
+    # same thread budget as build_workflow: split --nthreads into --omp-nthreads sized workers
+    nthreads = opts.nthreads if opts.nthreads and opts.nthreads > 0 else cpu_count()
+    omp_nthreads = opts.omp_nthreads or min(nthreads - 1 if nthreads > 1 else cpu_count(), 8)
+    with report.timer('deface'):
+        # recorded relative to the BIDS root, the images are defaced in a different staging dir
+        # each time
+        defaced = deface_images(t1_files, os.path.join(opts.work_dir, 'deface_manifest.json'),
+                                n_procs=max(1, nthreads // omp_nthreads),
+                                omp_nthreads=omp_nthreads, report=report, root=stage_dir)
+    report.add('deface', count=len(defaced))
+    # downloaded_func_files = glob.glob(os.path.join(download_dir,
+    #                                                'sub-%s' % opts.participant_label[0].replace('_',''),
+    #                                                opts.session,"func","*")
+    #                                   )
+    # downloaded_anat_files = glob.glob(os.path.join(download_dir,
+    #                                                'sub-%s' % opts.participant_label[0].replace('_',''),
+    #                                                opts.session,"anat","*")
+    #                                   )
+
+    # for file in downloaded_func_files:
+    #     os.system('mv %s %s' % (file, func_dir))
+    #
+    # for file in downloaded_anat_files:
+    #     os.system('mv %s %s' % (file, anat_dir))
+
+
+def _publish(stage_dir, bids_dir):
+    """Move the subject and top level files staged in ``stage_dir`` into ``bids_dir``, one rename each"""
+    for name in os.listdir(stage_dir):
+        source = os.path.join(stage_dir, name)
+        target = os.path.join(bids_dir, name)
+        if os.path.isdir(source) and os.path.isdir(target):
+            # published by a concurrent staging of the same subject
+            shutil.rmtree(target)
+        os.replace(source, target)
+
+
+def subject_paths(opts, participant):
+    """The staged data, downloaded archives and nipype work dir of ``participant``"""
+    label = participant.replace('_', '')
+    if label.startswith('sub-'):
+        label = label[4:]
+    work_dir = Path(opts.work_dir)
+    return ([work_dir / 'bids' / ('sub-%s' % label),
+             # base directory of the fmriprep workflow init_base_wf builds on
+             work_dir / 'fmriprep_wf' / ('single_subject_%s_wf' % label)] +
+            sorted((work_dir / 'downloads').glob('*/%s_*.tgz' % label)))
+
+
+def remove_staged(opts, participant):
+    """Delete the staged BIDS data and the downloaded archives of ``participant``"""
+    paths = subject_paths(opts, participant)
+    # the nipype work dir (second) is left to --evict_completed
+    for path in [paths[0]] + paths[2:]:
+        if path.is_dir():
+            shutil.rmtree(str(path), ignore_errors=True)
+        elif path.exists():
+            path.unlink()
+
+
+def admission_footprint(opts, archive_bytes, bold_files=()):
+    """
+    Bytes ``--disk_admission`` holds in the work dir for a participant: its staged data, and
+    the workflow it runs unless that runs under a ``--scratch_dir`` on another filesystem
+    """
+    from ..utils.disk_space import estimate_footprint, same_filesystem, staged_bytes
+
+    if opts.scratch_dir is not None and not same_filesystem(opts.scratch_dir, opts.work_dir):
+        return staged_bytes(archive_bytes, stream_extract=opts.stream_extract)
+    return estimate_footprint(archive_bytes, bold_files=bold_files,
+                              stream_extract=opts.stream_extract)
+
+
+def scratch_footprint(opts, participants):
+    """Bytes the run of the staged ``participants`` writes under ``--scratch_dir``"""
+    from ..utils.disk_space import work_bytes
+
+    total = 0
+    for participant in participants:
+        subject_dir = subject_paths(opts, participant)[0]
+        bold_files = sorted(subject_dir.glob('*/func/*_bold.nii*'))
+        # the copy of the staged data and the work dir of the workflow
+        total += _dir_size(subject_dir) + work_bytes(0, bold_files)
+    return total
+
+
+def write_run_report(report, output_dir, run_uuid):
+    """Save ``report`` next to the nipype logs of the run"""
+    label = report.participant.replace('_', '')
+    if not label.startswith('sub-'):
+        label = 'sub-' + label
+    return report.write(Path(output_dir) / 'uchicagoABCDProcessing' / 'logs' /
+                        ('%s_run-%s_throughput.json' % (label, run_uuid)))
+
+
+def get_workflow(logger, opts=None, exec_env=None, stage=True, report=None):
+    """
+    Build a single workflow holding all the participants in ``opts`` (parsed from the command
+    line when not given), staging their data first unless ``stage`` is False. The time spent staging,
+    validating and building is added to ``report`` and saved with the logs of the run.
+    """
+    from nipype import logging as nlogging
+    from multiprocessing import set_start_method, Process, Manager
+    from ..utils.bids import validate_input_dir
+    from .build_workflow import build_workflow
+    from ..utils.run_report import RunReport
+    if __name__ == 'main':
+        set_start_method('forkserver')
+    if opts is None:
+        opts, exec_env = get_opts()
+    if report is None:
+        report = RunReport('+'.join(opts.participant_label))
+
     bids_dir = os.path.join(opts.work_dir, 'bids')
 
-    if not opts.skip_download:
-        from NDATools.Configuration import ClientConfiguration
-        aws_token_info = os.popen(
-            "bash $NDA_TOKEN_GEN_DIR/curl/generate_token.sh '%s' '%s' 'https://nda.nih.gov/DataManager/dataManager'"
-            % (opts.nda_username, opts.nda_password)
-        ).readlines()
-        secret_key = aws_token_info[2].split(':')[1].strip()
-        access_key = aws_token_info[1].split(':')[1].strip()
-        # session_token = aws_token_info[3].split(':')[1].strip()
-        # get_files = OracleQuery()
-        # get_files.inputs.username = opts.miNDAR_username
-        # get_files.inputs.password = opts.miNDAR_password
-        # get_files.inputs.host = opts.miNDAR_host
-        # get_files.inputs.service = 'ORCL'
-        # get_files.inputs.write_to_file=False
-        #
-        # get_files.inputs.query = "select column_name from USER_TAB_COLUMNS where table_name = 'FMRIRESULTS01'"
-        # get_files.run()
-        # columns = get_files._results['out'].values.flatten()
-        # scan_type = numpy.argwhere(columns == 'SCAN_TYPE').flatten()[0]
-        # file_link = numpy.argwhere(columns == 'DERIVED_FILES').flatten()[0]
-        #
-        # get_files.inputs.query = "select * from FMRIRESULTS01 where SUBJECTKEY = '%s'" % opts.participant_label[0]
-        # get_files.run()
-        # subject_files = get_files._results['out']
-        #
-        # anat_and_func_files =subject_files[(subject_files[scan_type] =='MR structural (T1)') | (subject_files[scan_type] =='fMRI')][file_link].values
-        anat_and_func_files = ['s3://NDAR_Central_2/submission_19161/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414114436.tgz',
-                               's3://NDAR_Central_2/submission_19161/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414120922.tgz',
-                               's3://NDAR_Central_2/submission_19161/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414121456.tgz',
-                               's3://NDAR_Central_2/submission_19161/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414113822.tgz',
-                               's3://NDAR_Central_2/submission_19137/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-MID-fMRI_20170414123932.tgz',
-                               's3://NDAR_Central_2/submission_19137/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-MID-fMRI_20170414123343.tgz',
-                               # 's3://NDAR_Central_2/submission_19137/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-T1_20170414113634.tgz',
-                               's3://NDAR_Central_3/submission_19178/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-SST-fMRI_20170414125453.tgz',
-                               's3://NDAR_Central_3/submission_19178/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-nBack-fMRI_20170414122216.tgz',
-                               's3://NDAR_Central_3/submission_19178/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-SST-fMRI_20170414124837.tgz',
-                               's3://NDAR_Central_3/submission_19178/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-nBack-fMRI_20170414122744.tgz'
-                               ]
-
-        download_links = os.path.join(opts.work_dir,'alls3.txt')
-        os.makedirs(Path(download_links).parent, exist_ok=True)
-        with open(download_links,'w') as file:
-            for link in anat_and_func_files:
-                file.writelines(link+'\n')
-
-        nda_config = ClientConfiguration(
-            username=opts.nda_username,
-            password=opts.nda_password,
-            secret_key=secret_key,
-            access_key=access_key,
-            settings_file='clientscripts/config/settings.cfg'
-        )
-        nda_config.make_config()
-
-        download_dir = os.path.join(opts.work_dir,'downloads')
-        os.system("downloadcmd %s -t -d %s" % (download_links, download_dir)) # download all the files
-
-
-        subject_dir = os.path.join(bids_dir, 'sub-%s' % opts.participant_label[0].replace('_',''))
-        session_dir = os.path.join(subject_dir, opts.session)
-        func_dir = os.path.join(session_dir,'func')
-        anat_dir = os.path.join(session_dir, 'anat')
-
-        os.makedirs(func_dir, exist_ok=True)
-        os.makedirs(anat_dir, exist_ok=True)
-
-        downloaded_files = glob.glob(os.path.join(download_dir,"*","*.tgz"))
-
-        for download in downloaded_files:  # untar files
-            print('untaring %s' % download)
-            os.system('tar zxvf %s -C %s' % (download, bids_dir))
-            print()
-        t1_files = glob.glob(os.path.join(bids_dir,
-                                                       'sub-%s' % opts.participant_label[0].replace('_',''),
-                                                       opts.session,"anat","*T1w.nii")
-                                          )
-        for t1 in t1_files:
-            os.system('pydeface %s --outfile %s --force' % (t1, t1))
-        # downloaded_func_files = glob.glob(os.path.join(download_dir,
-        #                                                'sub-%s' % opts.participant_label[0].replace('_',''),
-        #                                                opts.session,"func","*")
-        #                                   )
-        # downloaded_anat_files = glob.glob(os.path.join(download_dir,
-        #                                                'sub-%s' % opts.participant_label[0].replace('_',''),
-        #                                                opts.session,"anat","*")
-        #                                   )
-
-        # for file in downloaded_func_files:
-        #     os.system('mv %s %s' % (file, func_dir))
-        #
-        # for file in downloaded_anat_files:
-        #     os.system('mv %s %s' % (file, anat_dir))
+    if stage and not opts.skip_download:
+        for participant in opts.participant_label:
+            stage_participant(opts, participant, report=report)
+
     opts.bids_dir = Path(bids_dir)
-    opts.participant_label = ['sub-' + opts.participant_label[0].replace('_','')]
+    opts.participant_label = ['sub-' + participant.replace('_','') for participant in opts.participant_label]
 
     # Validate inputs
     if not opts.skip_bids_validation:
         print("Making sure the input data is BIDS compliant (warnings can be ignored in most "
               "cases).")
-        validate_input_dir(exec_env, opts.bids_dir, opts.participant_label)
+        with report.timer('validation'):
+            validate_input_dir(exec_env, opts.bids_dir, opts.participant_label)
 
     # Retrieve logging level
     log_level = int(max(25 - 5 * opts.verbose_count, logging.DEBUG))
@@ -468,7 +759,7 @@ def get_workflow(logger):
     nlogging.getLogger('nipype.utils').setLevel(log_level)
 
     # Call build_workflow(opts, retval)
-    with Manager() as mgr:
+    with Manager() as mgr, report.timer('build'):
         retval = mgr.dict()
         p = Process(target=build_workflow, args=(opts, retval))
         p.start()
@@ -484,6 +775,9 @@ def get_workflow(logger):
         neuroHurst_wf = retval.get('workflow', None)
         run_uuid = retval.get('run_uuid', None)
 
+    if run_uuid is not None:
+        write_run_report(report, output_dir, run_uuid)
+
     if opts.reports_only:
         sys.exit(int(retcode > 0))
 
@@ -512,4 +806,8 @@ def get_workflow(logger):
         from ..utils.sentry import start_ping
         start_ping(run_uuid, len(subject_list))
 
-    return neuroHurst_wf, plugin_settings, opts, output_dir, work_dir, bids_dir, subject_list, run_uuid
\ No newline at end of file
+    return neuroHurst_wf, plugin_settings, opts, output_dir, work_dir, bids_dir, subject_list, run_uuid
+
+
+def _dir_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
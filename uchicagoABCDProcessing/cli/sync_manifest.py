@@ -0,0 +1,72 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Synchronize the local FMRIRESULTS01 manifest with miNDAR."""
+
+import logging
+from argparse import ArgumentParser
+from argparse import ArgumentDefaultsHelpFormatter
+from pathlib import Path
+
+logger = logging.getLogger('cli')
+
+
+def get_parser():
+    """Build parser object"""
+    parser = ArgumentParser(description='Index miNDAR FMRIRESULTS01 in a local SQLite manifest',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('manifest', action='store', type=Path,
+                        help='the SQLite manifest to create or update')
+    parser.add_argument('--miNDAR_host', action='store', type=str, required=True,
+                        help='miDNAR host')
+    parser.add_argument('--miNDAR_password', action='store', type=str, required=True,
+                        help='miDNAR password')
+    parser.add_argument('--miNDAR_username', action='store', type=str, required=True,
+                        help='miDNAR username')
+    parser.add_argument('--miNDAR_service', action='store', type=str, default='ORCL',
+                        help='miDNAR service')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='only fetch the rows added since the last sync')
+    parser.add_argument('--watermark_column', action='store', type=str,
+                        default='FMRIRESULTS01_ID',
+                        help='increasing FMRIRESULTS01 column used to find the new rows')
+    parser.add_argument('--nda_username', action='store', type=str,
+                        help='NDA username, when given the size and ETag of new objects are '
+                             'recorded from S3')
+    parser.add_argument('--nda_password', action='store', type=str,
+                        help='nda password')
+    parser.add_argument('--nda_token_cache', action='store', type=Path, default=None,
+                        help='file where NDA credentials are cached and shared between runs')
+    parser.add_argument('--s3_endpoint_url', action='store', type=str, default=None,
+                        help='alternative S3 endpoint (e.g. a local test server)')
+    parser.add_argument('--nthreads', action='store', type=int, default=8,
+                        help='number of concurrent S3 requests')
+    return parser
+
+
+def main():
+    """Entry point"""
+    from ..utils.manifest import Manifest, sync_manifest
+
+    opts = get_parser().parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    s3_client = None
+    if opts.nda_username:
+        from ..utils.download import get_s3_client
+        from ..utils.nda_token import NDATokenProvider
+        token_provider = NDATokenProvider(opts.nda_username, opts.nda_password,
+                                          cache_file=opts.nda_token_cache)
+        s3_client = get_s3_client(token_provider, endpoint_url=opts.s3_endpoint_url,
+                                  max_connections=opts.nthreads)
+
+    n_rows = sync_manifest(Manifest(opts.manifest), opts.miNDAR_username, opts.miNDAR_password,
+                           opts.miNDAR_host, service=opts.miNDAR_service, s3_client=s3_client,
+                           n_procs=opts.nthreads, incremental=opts.incremental,
+                           watermark_column=opts.watermark_column)
+    logger.info('Synchronized %d rows into %s', n_rows, opts.manifest)
+
+
+if __name__ == '__main__':
+    raise RuntimeError("uchicagoABCDProcessing/cli/sync_manifest.py should not be run directly;\n"
+                       "Please `pip install` uchicagoABCDProcessing and use the "
+                       "`uchicagoABCDProcessing-sync-manifest` command")
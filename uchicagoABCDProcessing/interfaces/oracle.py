@@ -3,12 +3,18 @@ import os
 import pandas
 from nipype.interfaces.base import (
     traits, TraitedSpec, SimpleInterface,
-    File)
+    File, isdefined)
 from nipype import logging
 import cx_Oracle
 
+from ..utils.columnar import open_writer, arrow_schema
+from ..utils.oracle_pool import get_pool, DEFAULT_POOL_SIZE, DEFAULT_IDLE_TIMEOUT
+from ..utils.query_cache import QueryCache, DEFAULT_TTL
+
 LOGGER = logging.getLogger('nipype.interface')
 
+DEFAULT_CHUNK_SIZE = 10000
+
 
 class OracleQueryInputSpec(TraitedSpec):
     username = traits.String(mandatory=True, desc='username for database')
@@ -16,7 +22,28 @@ class OracleQueryInputSpec(TraitedSpec):
     host = traits.String(mandatory=True, desc='host address for database')
     service = traits.String(mandatory=True, desc='database service')
     query = traits.String(mandator=True, desc='oracle sql query')
+    parameters = traits.Either(traits.List(), traits.Dict(), desc='bind variables of the query')
     write_to_file = traits.Bool(default_value=True, desc='write to output file')
+    output_format = traits.Enum('csv', 'parquet', 'arrow', usedefault=True,
+                                desc='format of the output file, parquet and arrow (Arrow IPC) '
+                                     'files keep the column names and types of the result and '
+                                     'are written batch by batch (requires pyarrow, never '
+                                     'cached)')
+    stream = traits.Bool(False, usedefault=True,
+                         desc='fetch the result in chunks and append each one to the output file '
+                              'as it arrives, keeping memory use flat')
+    chunk_size = traits.Int(DEFAULT_CHUNK_SIZE, usedefault=True,
+                            desc='rows fetched per round trip (cursor arraysize/prefetchrows)')
+    cache_dir = traits.String(desc='cache results in this directory (opt-in, streamed results are '
+                                   'never cached)')
+    cache_ttl = traits.Float(DEFAULT_TTL, usedefault=True,
+                             desc='seconds a cached result stays valid')
+    use_pool = traits.Bool(True, usedefault=True,
+                           desc='borrow the connection from a process-wide session pool')
+    pool_size = traits.Int(DEFAULT_POOL_SIZE, usedefault=True,
+                           desc='maximum number of sessions in the pool')
+    pool_timeout = traits.Int(DEFAULT_IDLE_TIMEOUT, usedefault=True,
+                              desc='seconds after which idle pooled sessions are closed')
 
 
 class OracleQueryOutputSpec(TraitedSpec):
@@ -28,7 +55,8 @@ class OracleQuery(SimpleInterface):
     """
     This is a simple interface for retrieving results of an sql query from an oracle database. The output is a pandas
     dataframe with query results. Note unless you build the column names into your query there are no column names
-    in the resulting dataframe.
+    in the resulting dataframe or csv file; parquet and arrow output files keep the names and types of the columns
+    so readers can load just the columns they need.
     """
     input_spec = OracleQueryInputSpec
     output_spec = OracleQueryOutputSpec
@@ -36,26 +64,99 @@ class OracleQuery(SimpleInterface):
     def _run_interface(self, runtime):
         cursor = None
         connection = None
+        pool = None
+        parameters = self.inputs.parameters if isdefined(self.inputs.parameters) else {}
+        # a failed run leaves no 'out', never the result of the previous run of this instance
+        self._results.pop('out', None)
+
+        cache = None
+        columnar = (self.inputs.output_format != 'csv'
+                    and (self.inputs.write_to_file or self.inputs.stream))
+        if isdefined(self.inputs.cache_dir) and not (self.inputs.stream or columnar):
+            cache = QueryCache(self.inputs.cache_dir)
+            cache_key = cache.key(self.inputs.query, parameters, self.inputs.host,
+                                  self.inputs.service, self.inputs.username)
+            out = cache.get(cache_key)
+            if out is not None:
+                LOGGER.debug('Using cached result of %s', self.inputs.query)
+                self._set_output(out)
+                return runtime
+
         try:
-            connection: cx_Oracle.Connection = cx_Oracle.connect('%s/%s@%s/%s' % (self.inputs.username, self.inputs.password, self.inputs.host, self.inputs.service))
-            """The format for the connection string is username/password@host/service"""
+            if self.inputs.use_pool:
+                pool = get_pool(self.inputs.username, self.inputs.password, self.inputs.host,
+                                self.inputs.service, pool_size=self.inputs.pool_size,
+                                idle_timeout=self.inputs.pool_timeout)
+                connection: cx_Oracle.Connection = pool.acquire()
+            else:
+                connection: cx_Oracle.Connection = cx_Oracle.connect('%s/%s@%s/%s' % (self.inputs.username, self.inputs.password, self.inputs.host, self.inputs.service))
+                """The format for the connection string is username/password@host/service"""
 
             cursor: cx_Oracle.Cursor = connection.cursor()  # connect
-            cursor.execute(self.inputs.query)  # execute the sql
+            if self.inputs.stream or columnar:
+                cursor.arraysize = self.inputs.chunk_size
+                if hasattr(cursor, 'prefetchrows'):  # cx_Oracle >= 8
+                    cursor.prefetchrows = self.inputs.chunk_size + 1
+            cursor.execute(self.inputs.query, parameters)  # execute the sql
+            if columnar:
+                self._results['out'] = self._write_columnar(cursor)
+                return runtime
+            if self.inputs.stream:
+                self._results['out'] = self._stream_to_csv(cursor)
+                return runtime
             rows = cursor.fetchall()  # retrieve the results
             out = pandas.DataFrame(rows)  # convert to pandas format
-            if self.inputs.write_to_file:
-                out_file = os.path.join(os.getcwd(), 'oracle_query_output.csv')  # make the output filename
-                out.to_csv(out_file)  # write out the results
-                self._results['out'] = out_file  # set the interface output
-            else:
-                self._results['out'] = out
+            if cache is not None:
+                cache.put(cache_key, out, ttl=self.inputs.cache_ttl)
+            self._set_output(out)
         except cx_Oracle.DatabaseError as e:
             print("There was a problem with Oracle: ",  e)
         finally:
             if cursor:
                 cursor.close()
-            if connection:
+            if connection and pool:
+                pool.release(connection)
+            elif connection:
                 connection.close()
 
         return runtime
+
+    def _set_output(self, out):
+        if self.inputs.write_to_file:
+            out_file = os.path.join(os.getcwd(), 'oracle_query_output.csv')  # make the output filename
+            out.to_csv(out_file)  # write out the results
+            self._results['out'] = out_file  # set the interface output
+        else:
+            self._results['out'] = out
+
+    def _stream_to_csv(self, cursor):
+        """Write the result chunk by chunk, in the same csv layout as the non streaming output"""
+        out_file = os.path.join(os.getcwd(), 'oracle_query_output.csv')
+        rows = cursor.fetchmany()
+        # the first chunk is written even when empty so the file always gets its header
+        pandas.DataFrame(rows).to_csv(out_file)
+        n_rows = len(rows)
+        while rows:
+            rows = cursor.fetchmany()
+            chunk = pandas.DataFrame(rows, index=range(n_rows, n_rows + len(rows)))
+            chunk.to_csv(out_file, mode='a', header=False)
+            n_rows += len(rows)
+        LOGGER.info('Streamed %d rows to %s', n_rows, out_file)
+        return out_file
+
+    def _write_columnar(self, cursor):
+        """Write the result batch by batch to a parquet or Arrow IPC file with named, typed columns"""
+        out_file = os.path.join(os.getcwd(), 'oracle_query_output.%s' % self.inputs.output_format)
+        columns = [column[0] for column in cursor.description]
+        writer = open_writer(out_file, columns, schema=arrow_schema(cursor.description))
+        n_rows = 0
+        try:
+            rows = cursor.fetchmany()
+            while rows:
+                writer.write(rows)
+                n_rows += len(rows)
+                rows = cursor.fetchmany()
+        finally:
+            writer.close()
+        LOGGER.info('Wrote %d rows (%s) to %s', n_rows, ', '.join(columns), out_file)
+        return out_file
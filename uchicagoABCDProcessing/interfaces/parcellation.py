@@ -0,0 +1,125 @@
+import os
+
+import numpy
+import nibabel
+from nipype.interfaces.base import (
+    traits, TraitedSpec, SimpleInterface,
+    File, InputMultiObject, OutputMultiObject)
+from nipype import logging
+
+
+LOGGER = logging.getLogger('nipype.interface')
+
+ATLAS_EXTENSIONS = ('.nii.gz', '.nii')
+
+
+def find_atlas(atlas_dir, parcellation):
+    """Label image of ``parcellation`` (e.g. ``shen_268.nii.gz``) in ``atlas_dir``"""
+    for extension in ATLAS_EXTENSIONS:
+        path = os.path.join(str(atlas_dir), parcellation + extension)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError('No label image for parcellation %s in %s (expected %s)' % (
+        parcellation, atlas_dir, ' or '.join(parcellation + e for e in ATLAS_EXTENSIONS)))
+
+
+def parcellation_mem_gb(bold_file, atlases):
+    """
+    Memory (GB) :class:`MultiAtlasTimeSeries` needs for ``bold_file`` once in the output space:
+    the float32 bold plus the copies of its voxels inside the atlases. The output space bold
+    keeps the voxel size of ``bold_file`` over the field of view of ``atlases``, whatever
+    their own voxel size (they are resampled to the bold).
+    """
+    bold_img = nibabel.load(bold_file)
+    n_volumes = bold_img.shape[3] if len(bold_img.shape) > 3 else 1
+    voxel_volume = numpy.prod(bold_img.header.get_zooms()[:3])
+    field_of_view = 0
+    for atlas in atlases:
+        atlas_img = nibabel.load(atlas)
+        field_of_view = max(field_of_view, numpy.prod(atlas_img.shape[:3]) *
+                            numpy.prod(atlas_img.header.get_zooms()[:3]))
+    n_voxels = field_of_view / voxel_volume
+    return 3 * 4 * float(n_voxels) * n_volumes / 1024 ** 3
+
+
+class MultiAtlasTimeSeriesInputSpec(TraitedSpec):
+    bold = File(exists=True, mandatory=True, desc='4D bold image')
+    atlases = InputMultiObject(File(exists=True), mandatory=True,
+                               desc='integer label images, 0 is background')
+    atlas_names = InputMultiObject(traits.String, mandatory=True,
+                                   desc='name of each atlas, used in the output file names')
+
+
+class MultiAtlasTimeSeriesOutputSpec(TraitedSpec):
+    time_series = OutputMultiObject(File(exists=True),
+                                    desc='roi time series csv (time x region, regions in the '
+                                         'order of their labels) of each atlas, in the order of '
+                                         'the atlases')
+
+
+class MultiAtlasTimeSeries(SimpleInterface):
+    """
+    Mean time series of the regions of several atlases. The bold image is loaded and decompressed
+    once for all the atlases, instead of once per atlas. Atlases not on the grid of the bold image
+    are resampled to it with nearest neighbour interpolation. Every label of an atlas gets a column,
+    regions left without a voxel on the grid of the bold image are NaN.
+    """
+    input_spec = MultiAtlasTimeSeriesInputSpec
+    output_spec = MultiAtlasTimeSeriesOutputSpec
+
+    def _run_interface(self, runtime):
+        if len(self.inputs.atlases) != len(self.inputs.atlas_names):
+            raise ValueError('%d atlases but %d atlas names' % (len(self.inputs.atlases),
+                                                                len(self.inputs.atlas_names)))
+        bold_img = nibabel.load(self.inputs.bold)
+        bold = bold_img.get_fdata(dtype=numpy.float32)
+        bold = bold.reshape(-1, bold.shape[-1])
+
+        base_name = os.path.basename(self.inputs.bold)
+        for extension in ATLAS_EXTENSIONS:
+            if base_name.endswith(extension):
+                base_name = base_name[:-len(extension)]
+                break
+
+        self._results['time_series'] = []
+        for atlas, atlas_name in zip(self.inputs.atlases, self.inputs.atlas_names):
+            atlas_img = nibabel.load(atlas)
+            # the columns are the labels of the atlas itself, so that they are the same for every
+            # bold whatever survives the resampling
+            regions = numpy.unique(numpy.asanyarray(atlas_img.dataobj).astype(numpy.int64))
+            regions = regions[regions > 0]
+            labels = _labels_on_grid(atlas_img, bold_img).reshape(-1)
+            in_atlas = labels > 0
+            present, region_of_voxel = numpy.unique(labels[in_atlas], return_inverse=True)
+
+            time_series = numpy.full((bold.shape[1], len(regions)), numpy.nan, dtype=numpy.float32)
+            if len(present):
+                # sum the voxels of each region in one pass over the voxels sorted by region
+                order = numpy.argsort(region_of_voxel, kind='stable')
+                starts = numpy.searchsorted(region_of_voxel[order], numpy.arange(len(present)))
+                sums = numpy.add.reduceat(bold[in_atlas][order], starts, axis=0)
+                counts = numpy.bincount(region_of_voxel, minlength=len(present))
+                time_series[:, numpy.searchsorted(regions, present)] = (
+                    sums / counts[:, numpy.newaxis]).T
+            missing = numpy.setdiff1d(regions, present)
+            if len(missing):
+                LOGGER.warning('%d regions of %s have no voxel on the grid of %s, their time '
+                               'series are NaN: %s', len(missing), atlas_name, self.inputs.bold,
+                               ', '.join(str(label) for label in missing))
+
+            output_file = os.path.join(runtime.cwd, '%s_%s.csv' % (base_name, atlas_name))
+            numpy.savetxt(output_file, time_series, delimiter=',')
+            LOGGER.info('Extracted %d of the %d regions of %s from %s', len(present), len(regions),
+                        atlas_name, self.inputs.bold)
+            self._results['time_series'].append(output_file)
+
+        return runtime
+
+
+def _labels_on_grid(atlas_img, bold_img):
+    shape = bold_img.shape[:3]
+    if atlas_img.shape[:3] == shape and numpy.allclose(atlas_img.affine, bold_img.affine):
+        return numpy.asanyarray(atlas_img.dataobj).astype(numpy.int64)
+    from nibabel.processing import resample_from_to
+    resampled = resample_from_to(atlas_img, (shape, bold_img.affine), order=0)
+    return numpy.asanyarray(resampled.dataobj).astype(numpy.int64)
@@ -0,0 +1,63 @@
+import os
+import shutil
+
+import numpy
+from enlNipypeInterfaces.interfaces import FisherRToZMatrix
+from neuroHurst.interfaces import DFA
+from nipype.interfaces.base import (
+    traits, TraitedSpec, SimpleInterface,
+    File, InputMultiObject, OutputMultiObject)
+from nipype import logging
+
+from .trim_time_series import trim
+
+LOGGER = logging.getLogger('nipype.interface')
+
+
+class FusedPostprocessingInputSpec(TraitedSpec):
+    ts = traits.String(mandatory=True, desc='roi_time_series_file')
+    bold = InputMultiObject(File(exists=True), mandatory=True,
+                            desc='deconfounded bold the time series was extracted from')
+
+
+class FusedPostprocessingOutputSpec(TraitedSpec):
+    trimmed = File(exists=True, desc='trimmed time series')
+    connectivity = OutputMultiObject(File(exists=True),
+                                     desc='fisher z transformed correlation matrix')
+    hurst = OutputMultiObject(File(exists=True), desc='dfa hurst exponent of each region')
+    confidence_intervals = OutputMultiObject(File(exists=True),
+                                             desc='confidence interval of each hurst exponent')
+    rsquared = OutputMultiObject(File(exists=True), desc='r squared of the dfa fit of each region')
+
+
+class FusedPostprocessing(SimpleInterface):
+    """
+    Trim, Fisher z connectivity and DFA hurst exponents of a parcelated time series in one node.
+    The time series is trimmed once and the FisherRToZMatrix and DFA interfaces run in process on
+    the trimmed file, instead of as three nodes the scheduler submits, hashes and caches one by
+    one. Their estimators are used as is, so the results are those of the separate nodes.
+    """
+    input_spec = FusedPostprocessingInputSpec
+    output_spec = FusedPostprocessingOutputSpec
+
+    def _run_interface(self, runtime):
+        # the same trimming as Trim, but the input file is left untouched
+        trimmed_file = os.path.join(runtime.cwd, os.path.basename(self.inputs.ts))
+        ts = numpy.loadtxt(self.inputs.ts, delimiter=',')
+        trimmed = trim(ts, self.inputs.ts)
+        if trimmed.shape[0] < ts.shape[0]:
+            numpy.savetxt(trimmed_file, trimmed, delimiter=',')
+        else:
+            shutil.copyfile(self.inputs.ts, trimmed_file)
+        self._results['trimmed'] = trimmed_file
+
+        connectivity = FisherRToZMatrix(csv=trimmed_file).run(
+            cwd=os.path.join(runtime.cwd, 'connectivity'))
+        self._results['connectivity'] = connectivity.outputs.connectivity
+
+        hurst = DFA(csv=trimmed_file, bold=self.inputs.bold).run(
+            cwd=os.path.join(runtime.cwd, 'dfa'))
+        for name in ('hurst', 'confidence_intervals', 'rsquared'):
+            self._results[name] = getattr(hurst.outputs, name)
+
+        return runtime
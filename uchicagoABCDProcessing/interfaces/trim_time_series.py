@@ -11,6 +11,18 @@ from nipype import logging
 LOGGER = logging.getLogger('nipype.interface')
 
 
+def trim(ts, ts_file):
+    """Drop the leading volumes of ``ts`` (time x region) beyond the length of the task named in ``ts_file``"""
+    lower_file = ts_file.lower()
+    new_length = 362 if lower_file.__contains__('nback') else 437 if lower_file.__contains__(
+        'sst') else 403 if lower_file.__contains__('mid') else 375
+    length = ts.shape[0]
+    if length > new_length:
+        trim_amount = length - new_length
+        ts = ts[trim_amount:, :]
+    return ts
+
+
 class TrimInputSpec(TraitedSpec):
     ts = traits.String(mandatory=True, desc='roi_time_series_file')
 
@@ -31,15 +43,10 @@ class Trim(SimpleInterface):
 
     def _run_interface(self, runtime):
         original_ts_file = self.inputs.ts
-        lower_file  = original_ts_file.lower()
         ts = numpy.loadtxt(original_ts_file, delimiter=',')
-        new_length = 362 if lower_file.__contains__('nback') else 437 if lower_file.__contains__(
-            'sst') else 403 if lower_file.__contains__('mid') else 375
-        length = ts.shape[0]
-        if length > new_length:
-            trim_amount = length - new_length
-            ts = ts[trim_amount:, :]
-            numpy.savetxt(original_ts_file, ts, delimiter=',')
+        trimmed = trim(ts, original_ts_file)
+        if trimmed.shape[0] < ts.shape[0]:
+            numpy.savetxt(original_ts_file, trimmed, delimiter=',')
 
         self._results['trimmed'] = original_ts_file
 
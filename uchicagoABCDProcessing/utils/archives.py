@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Extraction of ABCD tgz archives into the BIDS tree
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import os
+import shutil
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from multiprocessing import cpu_count
+from pathlib import Path, PurePosixPath
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+COPY_BUFSIZE = 1024 * 1024
+
+
+def member_patterns(session, task_id=None, ignore=()):
+    """
+    Include patterns for the archive members the pipeline reads for ``session``. Functional
+    members are restricted to ``task_id`` (in any case, see :func:`..download_plan.bids_task`)
+    when one is requested and fieldmaps are skipped when they are ignored.
+    >>> member_patterns('ses-baselineYear1Arm1', task_id='mid', ignore=['fieldmaps'])
+    ['sub-*/ses-baselineYear1Arm1/anat/*T1w*', 'sub-*/ses-baselineYear1Arm1/func/*_task-MID_*', 'dataset_description.json']
+    """
+    from .download_plan import bids_task
+
+    patterns = ['sub-*/%s/anat/*T1w*' % session]
+    if task_id:
+        patterns.append('sub-*/%s/func/*_task-%s_*' % (session, bids_task(task_id)))
+    else:
+        patterns.append('sub-*/%s/func/*' % session)
+    if 'fieldmaps' not in ignore:
+        patterns.append('sub-*/%s/fmap/*' % session)
+    patterns.append('dataset_description.json')
+    return patterns
+
+
+def is_wanted(name, include=None, exclude=None):
+    """
+    Check a member name against the include/exclude patterns
+    >>> is_wanted('sub-a/ses-b/func/x_bold.nii', include=['sub-*/ses-b/func/*'])
+    True
+    >>> is_wanted('sub-a/ses-b/func/x_bold.nii', exclude=['*_bold.nii'])
+    False
+    """
+    name = _normalize(name)
+    if include and not any(fnmatch(name, pattern) for pattern in include):
+        return False
+    if exclude and any(fnmatch(name, pattern) for pattern in exclude):
+        return False
+    return True
+
+
+def extract_stream(fileobj, dest, include=None, exclude=None, verify=None):
+    """
+    Extract the wanted members of a gzipped tar read sequentially from ``fileobj`` (e.g. an
+    S3 response body) into ``dest``. The archive itself is never written to disk. Extracted
+    files get the modification time of their member, and members whose file is already there
+    with that time (extracted by a previous staging) are not written again. The times are set
+    once the whole archive is read and ``verify()``, when given, has not raised: the files of
+    an archive that fails are written again on the next attempt. Returns the number of members
+    and bytes written.
+    """
+    n_members = 0
+    n_bytes = 0
+    written = []
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+        for member in tar:
+            if not member.isfile() or not is_wanted(member.name, include, exclude):
+                continue
+            target = _safe_target(dest, member.name)
+            if _unchanged(target, member):
+                LOGGER.debug('%s is up to date', target)
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            part_file = target.with_name(target.name + '.part')
+            with tar.extractfile(member) as source, part_file.open('wb') as out:
+                shutil.copyfileobj(source, out, COPY_BUFSIZE)
+            part_file.replace(target)
+            written.append((target, member.mtime))
+            n_members += 1
+            n_bytes += member.size
+    if verify is not None:
+        verify()
+    for target, mtime in written:
+        os.utime(str(target), (mtime, mtime))
+    return n_members, n_bytes
+
+
+def extract_archive(archive, dest, include=None, exclude=None):
+    """Extract the wanted members of a tgz file on disk, returning a timing record"""
+    start = time.time()
+    with open(str(archive), 'rb') as fobj:
+        n_members, n_bytes = extract_stream(fobj, dest, include, exclude)
+    return {'archive': str(archive),
+            'members': n_members,
+            'bytes': n_bytes,
+            'seconds': time.time() - start}
+
+
+def extract_archives(archives, dest, include=None, exclude=None, n_procs=None):
+    """
+    Extract all ``archives`` at once on a pool of ``n_procs`` processes, keeping only the
+    members matching ``include``/``exclude``. Returns one timing record per archive.
+    """
+    archives = list(archives)
+    if not archives:
+        return []
+    n_procs = max(1, min(n_procs or cpu_count(), len(archives)))
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        futures = [executor.submit(extract_archive, archive, dest, include, exclude)
+                   for archive in archives]
+
+    timings = []
+    failed = []
+    for archive, future in zip(archives, futures):
+        try:
+            timing = future.result()
+        except Exception as e:
+            LOGGER.error('Could not extract %s: %s', archive, e)
+            failed.append(str(archive))
+            continue
+        LOGGER.info('Extracted %d members (%.1f MB) from %s in %.1fs',
+                    timing['members'], timing['bytes'] / 1024 ** 2, archive, timing['seconds'])
+        timings.append(timing)
+    if failed:
+        raise RuntimeError('Failed to extract %d of %d archives: %s' % (
+            len(failed), len(archives), ', '.join(failed)))
+    return timings
+
+
+def _unchanged(target, member):
+    """
+    Whether ``target`` was extracted from ``member``. Only the modification time is compared,
+    defacing rewrites the T1w images in place but keeps their time (see :mod:`.deface`).
+    """
+    try:
+        return member.mtime > 0 and int(target.stat().st_mtime) == int(member.mtime)
+    except FileNotFoundError:
+        return False
+
+
+def _safe_target(dest, name):
+    """Resolve ``name`` inside ``dest``, refusing absolute paths and ``..`` components"""
+    relative = PurePosixPath(_normalize(name))
+    if relative.is_absolute() or '..' in relative.parts:
+        raise ValueError('Refusing to extract %s outside of %s' % (name, dest))
+    return Path(dest).joinpath(*relative.parts)
+
+
+def _normalize(name):
+    while name.startswith('./'):
+        name = name[2:]
+    return name
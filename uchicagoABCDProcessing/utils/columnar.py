@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Incremental writers for query results
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import csv
+from pathlib import Path
+
+
+def open_writer(path, columns, schema=None):
+    """
+    Open a writer that appends batches of rows to ``path``. ``.parquet`` files are written
+    with ``pyarrow`` (one row group per batch), ``.arrow``/``.feather`` files as an Arrow IPC
+    file (one record batch per batch) and anything else as csv with a header line. The Arrow
+    formats store every column as a string unless a ``schema`` (see :func:`arrow_schema`) is
+    given.
+    """
+    suffix = Path(path).suffix
+    if suffix == '.parquet':
+        return ParquetWriter(path, columns, schema)
+    if suffix in ('.arrow', '.feather'):
+        return ArrowWriter(path, columns, schema)
+    return CsvWriter(path, columns)
+
+
+def arrow_schema(description):
+    """
+    Build the ``pyarrow`` schema of a DB API ``cursor.description``, keeping the column names
+    and mapping the database types onto Arrow types. Unknown types are kept as strings.
+    """
+    import pyarrow
+
+    fields = []
+    for name, type_code, _, _, precision, scale, _ in description:
+        type_name = getattr(type_code, 'name', getattr(type_code, '__name__', str(type_code)))
+        type_name = type_name.upper()
+        if type_name.startswith('DB_TYPE_'):
+            type_name = type_name[len('DB_TYPE_'):]
+        if type_name == 'NUMBER':
+            arrow_type = pyarrow.int64() if precision and scale == 0 else pyarrow.float64()
+        elif type_name in ('BINARY_DOUBLE', 'BINARY_FLOAT', 'NATIVE_FLOAT'):
+            arrow_type = pyarrow.float64()
+        elif type_name in ('BINARY_INTEGER', 'NATIVE_INT'):
+            arrow_type = pyarrow.int64()
+        elif type_name in ('DATE', 'DATETIME', 'TIMESTAMP', 'TIMESTAMP_LTZ', 'TIMESTAMP_TZ'):
+            arrow_type = pyarrow.timestamp('us')
+        elif type_name in ('RAW', 'LONG_RAW', 'BINARY', 'BLOB'):
+            arrow_type = pyarrow.binary()
+        else:
+            arrow_type = pyarrow.string()
+        fields.append(pyarrow.field(name, arrow_type))
+    return pyarrow.schema(fields)
+
+
+class CsvWriter(object):
+    def __init__(self, path, columns):
+        self._fobj = open(str(path), 'w', newline='')
+        self._writer = csv.writer(self._fobj)
+        self._writer.writerow(columns)
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._fobj.flush()
+
+    def close(self):
+        self._fobj.close()
+
+
+class _ArrowBatches(object):
+    """Turn batches of rows into ``pyarrow`` tables of a fixed schema"""
+
+    def __init__(self, columns, schema=None):
+        import pyarrow
+
+        self.columns = list(columns)
+        if schema is None:
+            schema = pyarrow.schema([(column, pyarrow.string()) for column in self.columns])
+        self._schema = schema
+
+    def _table(self, rows):
+        import pyarrow
+
+        arrays = []
+        for field, column in zip(self._schema, zip(*rows)):
+            if pyarrow.types.is_string(field.type):
+                column = [None if value is None else str(value) for value in column]
+            arrays.append(pyarrow.array(column, type=field.type))
+        return pyarrow.Table.from_arrays(arrays, schema=self._schema)
+
+
+class ParquetWriter(_ArrowBatches):
+    def __init__(self, path, columns, schema=None):
+        import pyarrow.parquet
+
+        super(ParquetWriter, self).__init__(columns, schema)
+        self._writer = pyarrow.parquet.ParquetWriter(str(path), self._schema)
+
+    def write(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        self._writer.write_table(self._table(rows))
+
+    def close(self):
+        self._writer.close()
+
+
+class ArrowWriter(_ArrowBatches):
+    def __init__(self, path, columns, schema=None):
+        import pyarrow.ipc
+
+        super(ArrowWriter, self).__init__(columns, schema)
+        self._writer = pyarrow.ipc.new_file(str(path), self._schema)
+
+    def write(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        self._writer.write_table(self._table(rows))
+
+    def close(self):
+        self._writer.close()
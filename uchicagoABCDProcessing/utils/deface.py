@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Parallel defacing of anatomical images
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def deface_images(images, manifest_file, n_procs=1, omp_nthreads=1, report=None, root=None):
+    """
+    Deface ``images`` in place with ``pydeface`` on a pool of ``n_procs`` processes, each
+    limited to ``omp_nthreads`` threads. The sha256 of every defaced output is recorded in
+    ``manifest_file`` (under the path of the image relative to ``root`` when given, its absolute
+    path otherwise) and images whose content still matches their record are skipped. The
+    manifest is updated under a lock, so runs sharing a work directory can deface at once. The
+    time spent on each image is recorded in ``report`` when one is given. Returns the images
+    that were defaced.
+    """
+    manifest_file = Path(manifest_file)
+    manifest = _read_manifest(manifest_file)
+
+    def _key(image):
+        return os.path.relpath(image, str(Path(root).resolve())) if root is not None else image
+
+    todo = []
+    for image in images:
+        image = str(Path(image).resolve())
+        if manifest.get(_key(image)) == file_sha256(image):
+            LOGGER.info('%s is already defaced', image)
+        else:
+            todo.append(image)
+    if not todo:
+        return []
+
+    with ProcessPoolExecutor(max_workers=max(1, min(n_procs, len(todo)))) as executor:
+        futures = [executor.submit(_deface, image, omp_nthreads) for image in todo]
+
+        failed = []
+        for image, future in zip(todo, futures):
+            try:
+                digest, seconds = future.result()
+            except Exception as e:
+                LOGGER.error('Could not deface %s: %s', image, e)
+                failed.append(image)
+                continue
+            LOGGER.info('Defaced %s in %.1fs', image, seconds)
+            if report is not None:
+                report.record('deface', image, seconds)
+            _update_manifest(manifest_file, _key(image), digest)
+
+    if failed:
+        raise RuntimeError('Failed to deface %d of %d images: %s' % (
+            len(failed), len(todo), ', '.join(failed)))
+    return todo
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(str(path), 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _deface(image, omp_nthreads):
+    start = time.time()
+    stat = os.stat(image)
+    env = dict(os.environ, OMP_NUM_THREADS=str(omp_nthreads))
+    subprocess.run(['pydeface', image, '--outfile', image, '--force'], check=True, env=env)
+    # keep the time of the archive member, so restaging does not extract the image again
+    os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return file_sha256(image), time.time() - start
+
+
+def _read_manifest(manifest_file):
+    if manifest_file.exists():
+        return json.loads(manifest_file.read_text())
+    return {}
+
+
+def _update_manifest(manifest_file, key, digest):
+    """Record ``digest`` on top of the entries other runs wrote since the manifest was read"""
+    with _locked(manifest_file.with_name(manifest_file.name + '.lock')):
+        manifest = _read_manifest(manifest_file)
+        manifest[key] = digest
+        with tempfile.NamedTemporaryFile('w', dir=str(manifest_file.parent),
+                                         prefix=manifest_file.name, suffix='.tmp',
+                                         delete=False) as tmp:
+            tmp.write(json.dumps(manifest, indent=2, sort_keys=True))
+        os.replace(tmp.name, str(manifest_file))
+
+
+@contextmanager
+def _locked(lock_file):
+    with open(str(lock_file), 'a') as fobj:
+        fcntl.flock(fobj, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fobj, fcntl.LOCK_UN)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Disk space admission control of participants
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import errno
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+# the NIfTI files of the archives take about twice the space of the compressed tgz
+EXTRACT_RATIO = 2.0
+# float32 copies of each BOLD run kept in the work dir (hmc, sdc, t1w/std resampling,
+# confound regression, trimming, outputs)
+BOLD_WORK_COPIES = 12
+# anatomical workflow (skull stripping, segmentation, normalization)
+ANAT_WORK_BYTES = 2 * 1024 ** 3
+
+
+def bold_bytes(bold_file):
+    """Size of a float32 copy of ``bold_file``, read from its header"""
+    import nibabel
+
+    return int(numpy.prod(nibabel.load(str(bold_file)).header.get_data_shape())) * 4
+
+
+def estimate_footprint(archive_bytes, bold_files=(), stream_extract=False):
+    """
+    Bytes a participant takes on disk while it is staged and processed. Before staging the
+    work dir is extrapolated from the ``archive_bytes`` fetched from S3, once the BOLD runs are
+    extracted their header dimensions are used instead.
+    >>> estimate_footprint(1024 ** 3, stream_extract=True) / 1024 ** 3
+    28.0
+    """
+    return staged_bytes(archive_bytes, stream_extract) + work_bytes(archive_bytes, bold_files)
+
+
+def staged_bytes(archive_bytes, stream_extract=False):
+    """Bytes of the extracted data, and of the archives unless they are streamed"""
+    return int(archive_bytes * EXTRACT_RATIO + (0 if stream_extract else archive_bytes))
+
+
+def work_bytes(archive_bytes, bold_files=()):
+    """Bytes the workflow writes in its work dir, from the BOLD headers when they are known"""
+    if bold_files:
+        work = sum(bold_bytes(bold_file) for bold_file in bold_files) * BOLD_WORK_COPIES
+    else:
+        work = archive_bytes * EXTRACT_RATIO * BOLD_WORK_COPIES
+    return int(work + ANAT_WORK_BYTES)
+
+
+def same_filesystem(path, other):
+    """Whether the existing directories ``path`` and ``other`` are on the same filesystem"""
+    return os.stat(str(path)).st_dev == os.stat(str(other)).st_dev
+
+
+class DiskAdmission(object):
+    """
+    Hold participants until the filesystem of ``path`` has room for them.
+
+    :meth:`admit` blocks until the free space, minus what the admitted participants are still
+    expected to write and minus ``headroom_bytes``, covers the footprint of a new participant.
+    What a participant has written is reported through :meth:`update` rather than measured on
+    every poll, until then its whole footprint is held back. When ``evict`` is set the
+    directories of completed participants are deleted, oldest first, to make room. An
+    ``ENOSPC`` :class:`OSError` is raised after ``timeout`` seconds.
+    """
+
+    def __init__(self, path, headroom_bytes=0, evict=False, poll_interval=30, timeout=None):
+        self.path = str(path)
+        self.headroom_bytes = headroom_bytes
+        self.evict = evict
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._admitted = OrderedDict()
+        self._completed = OrderedDict()
+        self._holding = set()
+
+    def admit(self, label, nbytes):
+        """Wait for room for the ``nbytes`` participant ``label`` will write"""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            try:
+                self._wait_for_room(label, nbytes, deadline)
+            finally:
+                self._holding.discard(label)
+            self._admitted[label] = (nbytes, 0)
+        LOGGER.info('Admitted %s (%.1f GB estimated)', label, nbytes / 1024 ** 3)
+
+    def holding(self):
+        """Whether a participant is waiting for room"""
+        return bool(self._holding)
+
+    def _wait_for_room(self, label, nbytes, deadline):
+        while True:
+            available = self._available()
+            if available >= nbytes:
+                break
+            if self.evict and self._completed:
+                self._evict_oldest()
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                raise OSError(errno.ENOSPC, 'No space left on device for %s: %.1f GB needed, '
+                                            '%.1f GB available in %s' % (
+                                                label, nbytes / 1024 ** 3,
+                                                available / 1024 ** 3, self.path))
+            if label not in self._holding:
+                LOGGER.info('Holding %s until %.1f GB are free in %s (%.1f GB available)',
+                            label, nbytes / 1024 ** 3, self.path, available / 1024 ** 3)
+                self._holding.add(label)
+            self._cond.wait(self.poll_interval)
+
+    def update(self, label, nbytes=None, written=None):
+        """
+        Replace the footprint estimate of an admitted participant and/or the bytes it has
+        written so far
+        """
+        with self._cond:
+            if label in self._admitted:
+                previous_nbytes, previous_written = self._admitted[label]
+                self._admitted[label] = (previous_nbytes if nbytes is None else nbytes,
+                                         previous_written if written is None else written)
+                self._cond.notify_all()
+
+    def complete(self, label, paths=()):
+        """Release the reservation of ``label``, its ``paths`` may be evicted from now on"""
+        with self._cond:
+            self._admitted.pop(label, None)
+            if paths:
+                self._completed[label] = [Path(path) for path in paths]
+            self._cond.notify_all()
+
+    def _available(self):
+        # what admitted participants have already written is accounted for by the free space
+        pending = sum(max(0, nbytes - written) for nbytes, written in self._admitted.values())
+        return shutil.disk_usage(self.path).free - pending - self.headroom_bytes
+
+    def _evict_oldest(self):
+        label, paths = self._completed.popitem(last=False)
+        LOGGER.info('Evicting the work dirs of %s', label)
+        for path in paths:
+            if path.is_dir():
+                shutil.rmtree(str(path), ignore_errors=True)
+            elif path.exists():
+                path.unlink()
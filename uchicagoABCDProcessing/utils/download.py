@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Parallel, resumable download of ABCD archives from S3
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+CHUNK_SIZE = 8 * 1024 * 1024
+MULTIPART_CHUNK_SIZES = (8 * 1024 * 1024, 16 * 1024 * 1024)
+# objects of at least RANGE_THRESHOLD bytes can be fetched as concurrent RANGE_PART_SIZE ranges
+RANGE_THRESHOLD = 512 * 1024 * 1024
+RANGE_PART_SIZE = 64 * 1024 * 1024
+
+
+def parse_s3_url(url):
+    """
+    Split an ``s3://bucket/key`` url into its bucket and key
+    >>> parse_s3_url('s3://NDAR_Central_2/submission_19161/a.tgz')
+    ('NDAR_Central_2', 'submission_19161/a.tgz')
+    """
+    parsed = urlparse(url)
+    if parsed.scheme != 's3' or not parsed.netloc or not parsed.path.strip('/'):
+        raise ValueError('Not a valid S3 url: %s' % url)
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+def get_s3_client(token_provider, endpoint_url=None, max_connections=10):
+    """
+    Build a (thread safe) S3 client whose credentials come from an
+    :class:`..nda_token.NDATokenProvider` and are refreshed before they expire
+    """
+    import boto3
+    from botocore.config import Config
+    from botocore.credentials import RefreshableCredentials
+    from botocore.session import get_session
+
+    botocore_session = get_session()
+    botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=token_provider.metadata(),
+        refresh_using=token_provider.metadata,
+        method='nda-token',
+    )
+    return boto3.Session(botocore_session=botocore_session).client(
+        's3',
+        endpoint_url=endpoint_url,
+        config=Config(max_pool_connections=max_connections),
+    )
+
+
+def head_object(client, url, retries=5, backoff=1.0):
+    """Return ``(size, etag)`` of the object behind ``url``"""
+    bucket, key = parse_s3_url(url)
+    head = _with_retries(lambda: client.head_object(Bucket=bucket, Key=key),
+                         retries, backoff, 'HEAD %s' % url)
+    return head['ContentLength'], head['ETag'].strip('"')
+
+
+def head_part_size(client, url, etag):
+    """
+    Size of the parts a multipart object was uploaded in, from a HEAD of its first part. None for
+    single part objects and when the store does not answer part requests.
+    """
+    if '-' not in etag:
+        return None
+    bucket, key = parse_s3_url(url)
+    try:
+        return client.head_object(Bucket=bucket, Key=key, PartNumber=1)['ContentLength']
+    except Exception as e:
+        LOGGER.debug('Could not HEAD the first part of %s: %s', url, e)
+        return None
+
+
+def download_objects(client, urls, download_dir, n_procs=4, retries=5, backoff=1.0, cache=None,
+                     report=None, range_threshold=None, range_nprocs=4):
+    """
+    Download every url in ``urls`` into ``download_dir``, running up to ``n_procs`` transfers
+    at once. Objects are written to ``download_dir/<key>``. Partially transferred files are
+    resumed, failed transfers are retried with exponential backoff and every object is checked
+    against its size and ETag. When a :class:`..download_cache.DownloadCache` is given, cached
+    objects are linked from it instead of transferred. The transfer of every object is recorded
+    in ``report`` (a :class:`..run_report.RunReport`) when one is given. Objects of at least
+    ``range_threshold`` bytes are fetched as ``range_nprocs`` concurrent byte ranges (see
+    :func:`fetch_ranges`). Returns the local paths in the same order as ``urls``.
+    """
+    urls = list(urls)
+    if not urls:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(n_procs, len(urls)))) as executor:
+        futures = [executor.submit(download_object, client, url, download_dir, retries, backoff,
+                                   cache, report, range_threshold, range_nprocs)
+                   for url in urls]
+
+    paths = []
+    failed = []
+    for url, future in zip(urls, futures):
+        try:
+            paths.append(future.result())
+        except Exception as e:
+            LOGGER.error('Could not download %s: %s', url, e)
+            failed.append(url)
+    if failed:
+        raise RuntimeError('Failed to download %d of %d objects: %s' % (
+            len(failed), len(urls), ', '.join(failed)))
+    return paths
+
+
+def download_object(client, url, download_dir, retries=5, backoff=1.0, cache=None, report=None,
+                    range_threshold=None, range_nprocs=4):
+    """Download a single object, resuming from a previous ``.part`` file if one exists"""
+    start = time.time()
+    bucket, key = parse_s3_url(url)
+    out_file = Path(download_dir) / key
+    part_file = out_file.with_name(out_file.name + '.part')
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+
+    size, etag = head_object(client, url, retries, backoff)
+    etag_part_size = head_part_size(client, url, etag)
+    if (out_file.exists() and out_file.stat().st_size == size
+            and verify_etag(out_file, etag, etag_part_size)):
+        LOGGER.info('%s already downloaded', out_file)
+        _record(report, 'download', url, start, size, 0, source='local')
+        return out_file
+    if cache is not None and cache.fetch(url, etag, out_file):
+        _record(report, 'download', url, start, size, 0, source='cache')
+        return out_file
+
+    transferred = [0]  # across attempts, a failed attempt still moved its bytes
+
+    def _fetch():
+        offset = part_file.stat().st_size if part_file.exists() else 0
+        if offset > size:
+            part_file.unlink()
+            offset = 0
+        if offset < size:
+            request = {'Bucket': bucket, 'Key': key, 'IfMatch': '"%s"' % etag}
+            if offset:
+                LOGGER.info('Resuming %s at byte %d of %d', url, offset, size)
+                request['Range'] = 'bytes=%d-' % offset
+            body = client.get_object(**request)['Body']
+            with part_file.open('ab') as fobj:
+                for chunk in body.iter_chunks(CHUNK_SIZE):
+                    fobj.write(chunk)
+                    transferred[0] += len(chunk)
+        elif not size:
+            part_file.touch()
+
+        if part_file.stat().st_size != size or not verify_etag(part_file, etag, etag_part_size):
+            # the partial data cannot be trusted, start over on the next attempt
+            part_file.unlink()
+            raise IOError('%s does not match the size/ETag of %s' % (part_file, url))
+        part_file.replace(out_file)
+
+    if range_threshold and size >= range_threshold and range_nprocs > 1:
+        transferred[0] = fetch_ranges(client, url, size, etag, part_file, n_procs=range_nprocs,
+                                      retries=retries, backoff=backoff,
+                                      etag_part_size=etag_part_size)
+        part_file.replace(out_file)
+        source = 's3-ranges'
+    else:
+        _with_retries(_fetch, retries, backoff, 'GET %s' % url)
+        source = 's3'
+    LOGGER.info('Downloaded %s (%d bytes)', url, size)
+    _record(report, 'download', url, start, size, transferred[0], source=source)
+    if cache is not None:
+        cache.store(url, etag, out_file)
+    return out_file
+
+
+def fetch_ranges(client, url, size, etag, part_file, n_procs=4, part_size=RANGE_PART_SIZE,
+                 retries=5, backoff=1.0, etag_part_size=None):
+    """
+    Fetch the object behind ``url`` into ``part_file`` as ``part_size`` byte ranges, ``n_procs``
+    at a time, each written in place. The ranges already written are listed in a
+    ``<part_file>.ranges`` sidecar so an interrupted transfer resumes where it stopped. Each
+    range is retried on its own, the assembled file is checked against ``size`` and ``etag``
+    (``etag_part_size`` is the upload part size of a multipart object, see :func:`verify_etag`).
+    Returns the number of bytes fetched, the ranges of a previous transfer excluded.
+    """
+    bucket, key = parse_s3_url(url)
+    part_file = Path(part_file)
+    state_file = part_file.with_name(part_file.name + '.ranges')
+    n_parts = -(-size // part_size)
+
+    done = set()
+    if state_file.exists() and part_file.exists():
+        state = json.loads(state_file.read_text())
+        if (state['etag'], state['size'], state['part_size']) == (etag, size, part_size):
+            done = set(state['done'])
+    elif part_file.exists() and part_file.stat().st_size <= size:
+        # left by the single stream path, which writes sequentially
+        done = set(range(part_file.stat().st_size // part_size))
+    if done:
+        LOGGER.info('Resuming %s with %d of %d ranges already fetched', url, len(done), n_parts)
+
+    lock = threading.Lock()
+    transferred = [0]
+
+    def _save_state():
+        tmp = state_file.with_name(state_file.name + '.tmp')
+        tmp.write_text(json.dumps({'etag': etag, 'size': size, 'part_size': part_size,
+                                   'done': sorted(done)}))
+        tmp.replace(state_file)
+
+    with part_file.open('ab'):
+        pass
+    fd = os.open(str(part_file), os.O_WRONLY)
+    try:
+        os.ftruncate(fd, size)
+        _save_state()
+
+        def _fetch_range(index):
+            first = index * part_size
+            last = min(size, first + part_size) - 1
+            body = client.get_object(Bucket=bucket, Key=key, IfMatch='"%s"' % etag,
+                                     Range='bytes=%d-%d' % (first, last))['Body']
+            offset = first
+            for chunk in body.iter_chunks(CHUNK_SIZE):
+                while chunk:
+                    written = os.pwrite(fd, chunk, offset)
+                    offset += written
+                    chunk = chunk[written:]
+                    with lock:
+                        transferred[0] += written
+            if offset != last + 1:
+                raise IOError('Range %d-%d of %s ended at byte %d' % (first, last, url, offset))
+            with lock:
+                done.add(index)
+                _save_state()
+
+        todo = [index for index in range(n_parts) if index not in done]
+        with ThreadPoolExecutor(max_workers=max(1, min(n_procs, len(todo) or 1))) as executor:
+            futures = [executor.submit(_with_retries, lambda index=index: _fetch_range(index),
+                                       retries, backoff, 'GET %s range %d' % (url, index))
+                       for index in todo]
+        for future in futures:
+            future.result()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if part_file.stat().st_size != size or not verify_etag(part_file, etag, etag_part_size):
+        # only a mismatch with the known content hash gets here, the data is corrupt
+        part_file.unlink()
+        state_file.unlink()
+        raise IOError('%s does not match the size/ETag of %s' % (part_file, url))
+    state_file.unlink()
+    return transferred[0]
+
+
+def stream_extract_objects(client, urls, dest, include=None, exclude=None, n_procs=4, retries=5,
+                           backoff=1.0, cache=None, report=None):
+    """
+    Stream every archive in ``urls`` straight into ``dest``, decompressing it as it arrives and
+    writing only the wanted members (see :func:`..archives.extract_stream`). Nothing but the
+    extracted members touches the disk. Archives already in ``cache`` are extracted from there
+    without any transfer. Returns ``(n_members, n_bytes)`` per url.
+    """
+    urls = list(urls)
+    if not urls:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(n_procs, len(urls)))) as executor:
+        futures = [executor.submit(stream_extract_object, client, url, dest, include, exclude,
+                                   retries, backoff, cache, report)
+                   for url in urls]
+
+    results = []
+    failed = []
+    for url, future in zip(urls, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            LOGGER.error('Could not stream %s: %s', url, e)
+            failed.append(url)
+    if failed:
+        raise RuntimeError('Failed to stream %d of %d objects: %s' % (
+            len(failed), len(urls), ', '.join(failed)))
+    return results
+
+
+def stream_extract_object(client, url, dest, include=None, exclude=None, retries=5, backoff=1.0,
+                          cache=None, report=None):
+    """
+    Extract a single archive while downloading it. A stream can not be resumed, so a failed
+    attempt starts over and rewrites the members it already extracted.
+    """
+    from .archives import extract_stream
+
+    start = time.time()
+    bucket, key = parse_s3_url(url)
+    size, etag = head_object(client, url, retries, backoff)
+    cached = cache.path(url, etag) if cache is not None else None
+    if cached is not None and cached.exists():
+        LOGGER.info('Extracting cached copy of %s', url)
+        with cached.open('rb') as fobj:
+            n_members, n_bytes = extract_stream(fobj, dest, include, exclude)
+        _record(report, 'stream_extract', url, start, size, 0, source='cache',
+                extracted_bytes=n_bytes)
+        return n_members, n_bytes
+
+    transferred = [0]
+
+    def _stream():
+        body = client.get_object(Bucket=bucket, Key=key, IfMatch='"%s"' % etag)['Body']
+        reader = _HashingReader(body)
+
+        def _verify():
+            reader.drain()  # the tar end-of-archive padding is not always read
+            if reader.n_bytes != size or ('-' not in etag and reader.hexdigest() != etag):
+                raise IOError('Stream of %s does not match its size/ETag' % url)
+
+        try:
+            # the members only get their time, which marks them extracted, once verified
+            return extract_stream(reader, dest, include, exclude, verify=_verify)
+        finally:
+            transferred[0] += reader.n_bytes
+
+    n_members, n_bytes = _with_retries(_stream, retries, backoff, 'GET %s' % url)
+    LOGGER.info('Extracted %d members (%d bytes) from %s', n_members, n_bytes, url)
+    _record(report, 'stream_extract', url, start, size, transferred[0], source='s3',
+            extracted_bytes=n_bytes)
+    return n_members, n_bytes
+
+
+class _HashingReader(object):
+    """File-like wrapper that counts and md5-hashes the bytes read through it"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._md5 = hashlib.md5()
+        self.n_bytes = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._md5.update(data)
+        self.n_bytes += len(data)
+        return data
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+def verify_etag(path, etag, part_size=None):
+    """
+    Check a local file against an S3 ETag. Single part ETags are the md5 of the content.
+    Multipart ETags (``<md5 of part md5s>-<n parts>``) depend on the part size of the upload:
+    when ``part_size`` is known (see :func:`head_part_size`) the file must match it, otherwise
+    the usual part sizes are tried and, if none of them matches, the file can not be verified
+    and only its size is trusted.
+    """
+    if '-' not in etag:
+        return _md5(path) == etag
+
+    n_parts = int(etag.split('-')[1])
+    size = Path(path).stat().st_size
+    if part_size:
+        return _multipart_etag(path, part_size) == etag
+    if size and n_parts:
+        candidates = set(MULTIPART_CHUNK_SIZES)
+        candidates.add(-(-size // n_parts))
+        candidates.add(_round_up_mb(-(-size // n_parts)))
+        if any(_multipart_etag(path, c) == etag for c in candidates if -(-size // c) == n_parts):
+            return True
+    LOGGER.warning('Can not infer the part size of %s to check it against the ETag %s, '
+                   'only its size was checked', path, etag)
+    return True
+
+
+def _md5(path):
+    md5 = hashlib.md5()
+    with open(str(path), 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _multipart_etag(path, part_size):
+    digests = []
+    with open(str(path), 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(part_size), b''):
+            digests.append(hashlib.md5(chunk).digest())
+    return '%s-%d' % (hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+def _record(report, stage, url, start, nbytes, transferred, **extra):
+    """
+    Record an object of ``nbytes`` bytes, and add the ``transferred`` bytes that came from S3
+    (none for local and cached copies) to the totals of ``stage``
+    """
+    if report is not None:
+        report.record(stage, url, time.time() - start, nbytes, transferred=transferred, **extra)
+        report.add(stage, nbytes=transferred)
+
+
+def _round_up_mb(nbytes):
+    mb = 1024 * 1024
+    return -(-nbytes // mb) * mb
+
+
+def _with_retries(func, retries, backoff, description):
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            LOGGER.warning('%s failed (%s), retrying in %.1fs (%d/%d)',
+                           description, e, delay, attempt + 1, retries)
+            time.sleep(delay)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Content addressed cache of downloaded archives shared across subjects and runs
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import hashlib
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+
+class DownloadCache(object):
+    """
+    Objects are stored under ``root`` keyed by their S3 url and ETag, so a changed object is a
+    cache miss. Hits are hardlinked into the work directory (or copied when the cache lives on
+    another filesystem). Every hit refreshes the entry's mtime, and the least recently used
+    entries are evicted once the cache grows beyond ``quota_bytes``.
+    """
+
+    def __init__(self, root, quota_bytes=None):
+        self.root = Path(root)
+        self.quota_bytes = quota_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(url, etag):
+        return hashlib.sha256(('%s\n%s' % (url, etag.strip('"'))).encode()).hexdigest()
+
+    def path(self, url, etag):
+        key = self.key(url, etag)
+        return self.root / key[:2] / key
+
+    def fetch(self, url, etag, dest):
+        """Link the cached copy of ``url`` to ``dest``, returns False on a cache miss"""
+        cached = self.path(url, etag)
+        try:
+            os.utime(str(cached))
+        except FileNotFoundError:
+            return False
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        _link(cached, dest)
+        LOGGER.info('Using cached copy of %s', url)
+        return True
+
+    def store(self, url, etag, src):
+        """Add a verified download to the cache and evict old entries if over quota"""
+        cached = self.path(url, etag)
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        _link(src, cached)
+        self.evict()
+        return cached
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in its quota"""
+        if self.quota_bytes is None:
+            return []
+        entries = []
+        for path in self.root.glob('??/*'):
+            if path.name.endswith('.tmp'):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.quota_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted.append(path)
+        if evicted:
+            LOGGER.info('Evicted %d entries from the download cache %s', len(evicted), self.root)
+        return evicted
+
+
+def _link(src, dst):
+    """Atomically place a hardlink (or, across filesystems, a copy) of ``src`` at ``dst``"""
+    dst = Path(dst)
+    tmp = dst.with_name('%s.%s.tmp' % (dst.name, uuid.uuid4().hex))
+    try:
+        os.link(str(src), str(tmp))
+    except OSError:
+        shutil.copyfile(str(src), str(tmp))
+    os.replace(str(tmp), str(dst))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Selection of the archives a run actually needs
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from posixpath import basename
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+# BIDS task label (as written by the ABCD BIDS conversion) -> ABCD series type
+TASK_SERIES = {
+    'rest': 'rsfMRI',
+    'MID': 'MID-fMRI',
+    'SST': 'SST-fMRI',
+    'nback': 'nBack-fMRI',
+}
+ANAT_SERIES = ('T1',)
+
+_ARCHIVE = re.compile(r'^(?P<subject>NDAR[A-Z0-9_]+?)_(?P<session>[A-Za-z0-9]+)_'
+                      r'ABCD-(?P<stage>[A-Za-z0-9]+)-(?P<series>.+)_(?P<acquired>\d{14})\.tgz$')
+_SUBMISSION = re.compile(r'/submission_(\d+)/')
+
+Archive = namedtuple('Archive', ['url', 'subject', 'session', 'series', 'acquired', 'submission'])
+DownloadPlan = namedtuple('DownloadPlan', ['urls', 'skipped', 'n_bytes', 'skipped_bytes'])
+
+
+def bids_task(task_id):
+    """
+    The BIDS task label of ``task_id``, whatever its case
+    >>> bids_task('mid'), bids_task('NBack')
+    ('MID', 'nback')
+    """
+    for label in TASK_SERIES:
+        if label.lower() == task_id.lower():
+            return label
+    raise ValueError('Unknown task %s, expected one of %s' % (task_id, ', '.join(TASK_SERIES)))
+
+
+def parse_archive(url):
+    """
+    Split the url of an ABCD archive into its parts, None when it does not follow the naming
+    convention
+    >>> parse_archive('s3://NDAR_Central_2/submission_19161/'
+    ...               'NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414114436.tgz')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    Archive(url='s3://NDAR_Central_2/submission_19161/NDARINVRCE62M22_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414114436.tgz',
+            subject='NDARINVRCE62M22', session='baselineYear1Arm1', series='rsfMRI',
+            acquired='20170414114436', submission=19161)
+    """
+    match = _ARCHIVE.match(basename(url))
+    if match is None:
+        return None
+    submission = _SUBMISSION.search(url)
+    return Archive(url, match.group('subject'), match.group('session'), match.group('series'),
+                   match.group('acquired'), int(submission.group(1)) if submission else 0)
+
+
+def select_archives(urls, session=None, task_id=None):
+    """
+    Keep the archives of ``session`` holding the T1 or, when ``task_id`` is given, the runs of
+    that task. The same acquisition submitted more than once is fetched from the latest
+    submission only, and only the most recent T1 is kept. Urls that do not follow the ABCD
+    naming convention are always kept. Returns the selected and the skipped urls.
+    >>> urls = ['s3://b/submission_1/NDARINVA_baselineYear1Arm1_ABCD-MPROC-T1_20170414113634.tgz',
+    ...         's3://b/submission_2/NDARINVA_baselineYear1Arm1_ABCD-MPROC-T1_20170414113000.tgz',
+    ...         's3://b/submission_1/NDARINVA_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414114436.tgz',
+    ...         's3://b/submission_3/NDARINVA_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414114436.tgz',
+    ...         's3://b/submission_1/NDARINVA_baselineYear1Arm1_ABCD-MPROC-SST-fMRI_20170414125453.tgz']
+    >>> selected, skipped = select_archives(urls, 'ses-baselineYear1Arm1', task_id='rest')
+    >>> [url.split('/', 3)[3] for url in selected]  # doctest: +NORMALIZE_WHITESPACE
+    ['submission_1/NDARINVA_baselineYear1Arm1_ABCD-MPROC-T1_20170414113634.tgz',
+     'submission_3/NDARINVA_baselineYear1Arm1_ABCD-MPROC-rsfMRI_20170414114436.tgz']
+    >>> len(skipped)
+    3
+    """
+    if session is not None and session.startswith('ses-'):
+        session = session[4:]
+    wanted_series = [TASK_SERIES[bids_task(task_id)]] if task_id else list(TASK_SERIES.values())
+
+    selected = []
+    latest = {}
+    for url in urls:
+        archive = parse_archive(url)
+        if archive is None:
+            LOGGER.warning('Keeping %s, its name does not follow the ABCD convention', url)
+            selected.append(url)
+            continue
+        if session is not None and archive.session != session:
+            continue
+        if archive.series in ANAT_SERIES:
+            key = (archive.subject, archive.session, 'anat')
+            rank = (archive.acquired, archive.submission)
+        elif archive.series in wanted_series:
+            key = (archive.subject, archive.session, archive.series, archive.acquired)
+            rank = (archive.submission,)
+        else:
+            continue
+        if key not in latest or rank > latest[key][0]:
+            latest[key] = (rank, url)
+
+    keep = set(selected)
+    keep.update(url for _, url in latest.values())
+    return [url for url in urls if url in keep], [url for url in urls if url not in keep]
+
+
+def plan_downloads(urls, session=None, task_id=None, sizes=None, s3_client=None, n_procs=8,
+                   select=True):
+    """
+    Select the archives to fetch (see :func:`select_archives`, every url is kept unless
+    ``select``) and log the number of bytes they add up to before anything is transferred.
+    Sizes are taken from ``sizes`` (e.g. the manifest) and, for the selected urls missing
+    there, from a HEAD request when an S3 client is given.
+    """
+    from .download import head_object
+
+    urls = list(dict.fromkeys(urls))
+    if select:
+        selected, skipped = select_archives(urls, session=session, task_id=task_id)
+    else:
+        selected, skipped = urls, []
+    sizes = dict(sizes or {})
+
+    unknown = [url for url in selected if sizes.get(url) is None]
+    if unknown and s3_client is not None:
+        with ThreadPoolExecutor(max_workers=n_procs) as executor:
+            futures = [executor.submit(head_object, s3_client, url) for url in unknown]
+        for url, future in zip(unknown, futures):
+            try:
+                sizes[url] = future.result()[0]
+            except Exception as e:
+                LOGGER.warning('Could not HEAD %s: %s', url, e)
+
+    n_bytes = sum(sizes.get(url) or 0 for url in selected)
+    skipped_bytes = sum(sizes.get(url) or 0 for url in skipped)
+    n_unknown = sum(sizes.get(url) is None for url in selected)
+    LOGGER.info('Download plan: %d of %d archives, %.2f GB%s (skipping %.2f GB)',
+                len(selected), len(urls), n_bytes / 1024 ** 3,
+                ' + %d of unknown size' % n_unknown if n_unknown else '',
+                skipped_bytes / 1024 ** 3)
+    for url in skipped:
+        LOGGER.debug('Skipping %s', url)
+    return DownloadPlan(selected, skipped, n_bytes, skipped_bytes)
@@ -1,118 +1,136 @@
-import numpy
-import os
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Bulk export of the anatomical and functional file urls of ABCD participants from miNDAR
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+Participants are queried in batches with ``SUBJECTKEY IN (...)`` bind variables, the scan
+type filtering and column projection happen on the server, several batches are queried
+concurrently over pooled sessions and every batch is appended to the output file in order::
+
+    python -m uchicagoABCDProcessing.utils.get_subject_urls participants.csv subject_files.parquet \\
+        --miNDAR_host ... --miNDAR_username ... --miNDAR_password ...
+
+"""
+import logging
+from argparse import ArgumentParser
+from argparse import ArgumentDefaultsHelpFormatter
 from pathlib import Path
 
 import pandas
-from nipype.interfaces.base import (
-    traits, TraitedSpec, SimpleInterface,
-    File)
-from nipype import logging
-import cx_Oracle
 
-LOGGER = logging.getLogger('nipype.interface')
+from uchicagoABCDProcessing.utils.columnar import open_writer
+from uchicagoABCDProcessing.utils.manifest import SCAN_TYPES
+from uchicagoABCDProcessing.utils.query_cache import QueryCache
+from uchicagoABCDProcessing.utils.query_executor import QueryExecutor
 
+LOGGER = logging.getLogger('cli')
 
-class OracleQueryInputSpec(TraitedSpec):
-    username = traits.String(mandatory=True, desc='username for database')
-    password = traits.String(mandatory=True, desc='passowrd for database')
-    host = traits.String(mandatory=True, desc='host address for database')
-    service = traits.String(mandatory=True, desc='database service')
-    query = traits.String(mandator=True, desc='oracle sql query')
-    write_to_file = traits.Bool(default_value=True, desc='write to output file')
+COLUMNS = ('SUBJECTKEY', 'SCAN_TYPE', 'DERIVED_FILES')
+# Oracle limits IN lists to 1000 expressions
+BATCH_SIZE = 500
 
 
-class OracleQueryOutputSpec(TraitedSpec):
-    out_report = File(exists=True, desc='conformation report')
-    out = traits.Any(exists=True, desc='result of database query')
+def batch_query(n_subjects, scan_types=SCAN_TYPES):
+    """
+    Query for the file urls of ``n_subjects`` subjects bound as ``:s0, :s1, ...``
+    >>> batch_query(2, scan_types=['fMRI'])  # doctest: +NORMALIZE_WHITESPACE
+    'select distinct SUBJECTKEY, SCAN_TYPE, DERIVED_FILES from FMRIRESULTS01
+     where SCAN_TYPE in (:t0) and SUBJECTKEY in (:s0, :s1)'
+    """
+    return ('select distinct %s from FMRIRESULTS01 where SCAN_TYPE in (%s) and SUBJECTKEY in (%s)'
+            % (', '.join(COLUMNS),
+               ', '.join(':t%d' % i for i in range(len(scan_types))),
+               ', '.join(':s%d' % i for i in range(n_subjects))))
 
 
-class OracleQuery(SimpleInterface):
+def export_subject_urls(participants, out_file, username, password, host, service='ORCL',
+                        batch_size=BATCH_SIZE, scan_types=SCAN_TYPES, cache_dir=None,
+                        cache_ttl=None, n_threads=1, max_rate=None):
     """
-    This is a simple interface for retrieving results of an sql query from an oracle database. The output is a pandas
-    dataframe with query results. Note unless you build the column names into your query there are no column names
-    in the resulting dataframe.
+    Write the ``SUBJECTKEY``, ``SCAN_TYPE`` and ``DERIVED_FILES`` of the anatomical and
+    functional files of all ``participants`` to ``out_file`` (parquet or csv), one batch of
+    participants at a time. Up to ``n_threads`` batches are queried concurrently (starting at
+    most ``max_rate`` queries per second) and written in order. Batch results are served from
+    ``cache_dir`` when it holds an unexpired copy. Returns the number of rows written.
     """
-    input_spec = OracleQueryInputSpec
-    output_spec = OracleQueryOutputSpec
-
-    def _run_interface(self, runtime):
-        cursor = None
-        connection = None
-        try:
-            connection: cx_Oracle.Connection = cx_Oracle.connect('%s/%s@%s/%s' % (self.inputs.username, self.inputs.password, self.inputs.host, self.inputs.service))
-            """The format for the connection string is username/password@host/service"""
-
-            cursor: cx_Oracle.Cursor = connection.cursor()  # connect
-            cursor.execute(self.inputs.query)  # execute the sql
-            rows = cursor.fetchall()  # retrieve the results
-            out = pandas.DataFrame(rows)  # convert to pandas format
-            if self.inputs.write_to_file:
-                out_file = os.path.join(os.getcwd(), 'oracle_query_output.csv')  # make the output filename
-                out.to_csv(out_file)  # write out the results
-                self._results['out'] = out_file  # set the interface output
-            else:
-                self._results['out'] = out
-        except cx_Oracle.DatabaseError as e:
-            print("There was a problem with Oracle: ",  e)
-        finally:
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
-
-        return runtime
-
-
-nda_username='andrewstier'
-nda_password='Almian817'
-miNDAR_username='andrewstier_527849'
-miNDAR_password='uchicagoabcd'
-miNDAR_host='mindarvpc.cqahbwk3l1mb.us-east-1.rds.amazonaws.com'
-
-participants=pandas.read_csv('/home/andrewstier/Downloads/ABCD_Subjects_201_NotPhillips.csv')['subjectkey'].values
-
-os.system('export NDA_TOKEN_GEN_DIR=/home/andrewstier/nda_aws_token_generator')
-
-aws_token_info = os.popen(
-            "bash $NDA_TOKEN_GEN_DIR/curl/generate_token.sh '%s' '%s' 'https://nda.nih.gov/DataManager/dataManager'"
-            % (nda_username, nda_password)
-        ).readlines()
-secret_key = aws_token_info[2].split(':')[1].strip()
-access_key = aws_token_info[1].split(':')[1].strip()
-session_token = aws_token_info[3].split(':')[1].strip()
-
-paths = []
-i=0
-for participant in participants:
-    print(i)
-    i += 1
+    participants = list(participants)
+    executor = QueryExecutor(username, password, host, service=service, max_workers=n_threads,
+                             max_rate=max_rate, cache_dir=cache_dir, cache_ttl=cache_ttl)
+
+    queries = []
+    for start in range(0, len(participants), batch_size):
+        batch = participants[start:start + batch_size]
+        parameters = {'t%d' % i: scan_type for i, scan_type in enumerate(scan_types)}
+        parameters.update({'s%d' % i: subject for i, subject in enumerate(batch)})
+        queries.append((batch_query(len(batch), scan_types), parameters))
+
+    n_rows = 0
+    n_done = 0
+    writer = open_writer(out_file, COLUMNS)
     try:
-        get_files = OracleQuery()
-        get_files.inputs.username = miNDAR_username
-        get_files.inputs.password = miNDAR_password
-        get_files.inputs.host = miNDAR_host
-        get_files.inputs.service = 'ORCL'
-        get_files.inputs.write_to_file=False
-
-        get_files.inputs.query = "select column_name from USER_TAB_COLUMNS where table_name = 'FMRIRESULTS01'"
-        get_files.run()
-        columns = get_files._results['out'].values.flatten()
-        scan_type = numpy.argwhere(columns == 'SCAN_TYPE').flatten()[0]
-        file_link = numpy.argwhere(columns == 'DERIVED_FILES').flatten()[0]
-
-        get_files.inputs.query = "select * from FMRIRESULTS01 where SUBJECTKEY = '%s'" % participant
-        get_files.run()
-        subject_files = get_files._results['out']
-
-        anat_and_func_files =subject_files[(subject_files[scan_type] =='MR structural (T1)') | (subject_files[scan_type] =='fMRI')][file_link].values
-        new_paths = numpy.unique([str(Path(x)) for x in anat_and_func_files])
-        paths.append(new_paths)
-        temp = numpy.unique(numpy.hstack(paths))
-        paths=[]
-        paths.append(temp)
-        print()
-    except:
-        pass
-    if i % 100 == 0:
-        numpy.savetxt('/home/andrewstier/Downloads/subject_files.txt', paths[0],fmt='%s')
-numpy.savetxt('/home/andrewstier/Downloads/subject_files.txt', paths[0],fmt='%s')
\ No newline at end of file
+        for result in executor.imap(queries):
+            rows = list(result.itertuples(index=False, name=None))
+            writer.write(rows)
+            n_rows += len(rows)
+            n_done = min(n_done + batch_size, len(participants))
+            LOGGER.info('Exported %d/%d participants (%d files)',
+                        n_done, len(participants), n_rows)
+    finally:
+        writer.close()
+    return n_rows
+
+
+def get_parser():
+    """Build parser object"""
+    parser = ArgumentParser(description='Export the anatomical and functional file urls of ABCD '
+                                        'participants from miNDAR',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('participants', action='store', type=Path,
+                        help='csv file listing the participants')
+    parser.add_argument('out_file', action='store', type=Path,
+                        help='output file (.parquet, anything else is written as csv)')
+    parser.add_argument('--column', action='store', type=str, default='subjectkey',
+                        help='column of the participants file holding the subject keys')
+    parser.add_argument('--batch_size', action='store', type=int, default=BATCH_SIZE,
+                        help='number of participants per query')
+    parser.add_argument('--nthreads', action='store', type=int, default=4,
+                        help='number of queries run concurrently')
+    parser.add_argument('--max_query_rate', action='store', type=float, default=None,
+                        help='maximum number of queries started per second')
+    parser.add_argument('--query_cache_dir', action='store', type=Path, default=None,
+                        help='cache query results in this directory')
+    parser.add_argument('--query_cache_ttl', action='store', type=float, default=None,
+                        help='seconds a cached query result stays valid')
+    parser.add_argument('--invalidate_query_cache', action='store_true', default=False,
+                        help='drop every cached query result before exporting')
+    parser.add_argument('--miNDAR_host', action='store', type=str, required=True,
+                        help='miDNAR host')
+    parser.add_argument('--miNDAR_password', action='store', type=str, required=True,
+                        help='miDNAR password')
+    parser.add_argument('--miNDAR_username', action='store', type=str, required=True,
+                        help='miDNAR username')
+    parser.add_argument('--miNDAR_service', action='store', type=str, default='ORCL',
+                        help='miDNAR service')
+    return parser
+
+
+def main():
+    opts = get_parser().parse_args()
+    logging.basicConfig(level=logging.INFO)
+    participants = pandas.read_csv(opts.participants)[opts.column].dropna().unique()
+    if opts.invalidate_query_cache and opts.query_cache_dir is not None:
+        QueryCache(opts.query_cache_dir).invalidate()
+    n_rows = export_subject_urls(participants, opts.out_file, opts.miNDAR_username,
+                                 opts.miNDAR_password, opts.miNDAR_host,
+                                 service=opts.miNDAR_service, batch_size=opts.batch_size,
+                                 cache_dir=opts.query_cache_dir, cache_ttl=opts.query_cache_ttl,
+                                 n_threads=opts.nthreads, max_rate=opts.max_query_rate)
+    LOGGER.info('Wrote %d files of %d participants to %s', n_rows, len(participants),
+                opts.out_file)
+
+
+if __name__ == '__main__':
+    main()
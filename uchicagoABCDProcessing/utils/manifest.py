@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Local SQLite index of the miNDAR ``FMRIRESULTS01`` table
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+SCAN_TYPES = ('MR structural (T1)', 'fMRI')
+# monotonically increasing row id of FMRIRESULTS01, used as the high-water mark of syncs
+WATERMARK_COLUMN = 'FMRIRESULTS01_ID'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fmriresults01 (
+    derived_files TEXT PRIMARY KEY,
+    subjectkey TEXT NOT NULL,
+    scan_type TEXT,
+    file_size INTEGER,
+    etag TEXT
+);
+CREATE INDEX IF NOT EXISTS fmriresults01_subjectkey ON fmriresults01 (subjectkey, scan_type);
+CREATE TABLE IF NOT EXISTS sync_state (
+    watermark_column TEXT PRIMARY KEY,
+    watermark,
+    synced_at REAL
+);
+"""
+
+
+class Manifest(object):
+    """
+    Indexed local copy of the ``SUBJECTKEY``, ``SCAN_TYPE`` and ``DERIVED_FILES`` columns of
+    ``FMRIRESULTS01`` plus the size and ETag of each S3 object, so a subject's files can be
+    looked up without a database round trip.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        with closing(self._connect()) as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def upsert(self, rows):
+        """Add or update ``(subjectkey, scan_type, derived_files)`` rows"""
+        rows = _clean_rows(rows)
+        with closing(self._connect()) as connection, connection:
+            _upsert(connection, rows)
+        return len(rows)
+
+    def replace(self, rows):
+        """
+        Make ``(subjectkey, scan_type, derived_files)`` rows the whole content of the index, in
+        a single transaction. The size and ETag of the urls already indexed are kept.
+        """
+        rows = _clean_rows(rows)
+        with closing(self._connect()) as connection, connection:
+            _upsert(connection, rows)
+            connection.execute('CREATE TEMP TABLE synced (derived_files TEXT PRIMARY KEY)')
+            connection.executemany('INSERT OR IGNORE INTO synced VALUES (?)',
+                                   [(row[2],) for row in rows])
+            n_deleted = connection.execute(
+                'DELETE FROM fmriresults01 WHERE derived_files NOT IN '
+                '(SELECT derived_files FROM synced)').rowcount
+        if n_deleted:
+            LOGGER.info('Removed %d rows deleted from FMRIRESULTS01 from %s', n_deleted,
+                        self.path)
+        return len(rows)
+
+    def set_object_info(self, info):
+        """Record the ``(size, etag)`` of objects, ``info`` maps urls to these pairs"""
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                'UPDATE fmriresults01 SET file_size = ?, etag = ? WHERE derived_files = ?',
+                [(size, etag, url) for url, (size, etag) in info.items()])
+
+    def missing_object_info(self):
+        """Urls whose size/ETag have not been recorded yet"""
+        with closing(self._connect()) as connection:
+            return [row[0] for row in connection.execute(
+                'SELECT derived_files FROM fmriresults01 WHERE file_size IS NULL')]
+
+    def get_watermark(self, column=WATERMARK_COLUMN):
+        """Highest value of ``column`` seen by the last sync, or None"""
+        with closing(self._connect()) as connection:
+            row = connection.execute('SELECT watermark FROM sync_state WHERE watermark_column = ?',
+                                     (column,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_watermark(self, value, column=WATERMARK_COLUMN):
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                'INSERT INTO sync_state (watermark_column, watermark, synced_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (watermark_column) DO UPDATE SET watermark = excluded.watermark, '
+                'synced_at = excluded.synced_at', (column, value, time.time()))
+
+    def subject_objects(self, participant, scan_types=SCAN_TYPES):
+        """``(url, size, etag)`` of the files of ``participant`` with one of ``scan_types``"""
+        query = ('SELECT derived_files, file_size, etag FROM fmriresults01 '
+                 'WHERE subjectkey = ? AND scan_type IN (%s) ORDER BY derived_files' %
+                 ', '.join('?' * len(scan_types)))
+        with closing(self._connect()) as connection:
+            return connection.execute(query, (subject_key(participant),) + tuple(scan_types)
+                                      ).fetchall()
+
+    def subject_files(self, participant, scan_types=SCAN_TYPES):
+        return [url for url, _, _ in self.subject_objects(participant, scan_types)]
+
+
+def _clean_rows(rows):
+    return [(subjectkey, scan_type, derived_files.strip())
+            for subjectkey, scan_type, derived_files in rows if derived_files]
+
+
+def _upsert(connection, rows):
+    connection.executemany(
+        'INSERT INTO fmriresults01 (subjectkey, scan_type, derived_files) '
+        'VALUES (?, ?, ?) ON CONFLICT (derived_files) DO UPDATE SET '
+        'subjectkey = excluded.subjectkey, scan_type = excluded.scan_type', rows)
+
+
+def subject_key(participant):
+    """
+    Convert a participant label to an NDA ``SUBJECTKEY``
+    >>> subject_key('sub-NDARINVRCE62M22')
+    'NDAR_INVRCE62M22'
+    >>> subject_key('NDAR_INVRCE62M22')
+    'NDAR_INVRCE62M22'
+    """
+    if participant.startswith('sub-'):
+        participant = participant[4:]
+    if '_' not in participant and participant.startswith('NDAR'):
+        participant = 'NDAR_' + participant[4:]
+    return participant
+
+
+def sync_manifest(manifest, username, password, host, service='ORCL', s3_client=None,
+                  n_procs=8, incremental=False, watermark_column=WATERMARK_COLUMN):
+    """
+    Pull the anatomical and functional rows of ``FMRIRESULTS01`` into ``manifest`` and, when
+    an S3 client is given, record the size and ETag of objects not yet in the index.
+
+    A full sync replaces the content of the manifest, rows deleted upstream are removed. The
+    highest ``watermark_column`` value seen is kept in the manifest. With ``incremental`` only
+    the rows above it are fetched and merged, which falls back to a full sync the first time.
+    Incremental syncs only see new rows: rows deleted upstream, and rows updated in place
+    (e.g. a corrected ``DERIVED_FILES`` url) which keep their ``watermark_column`` value, are
+    missed until the next full sync.
+    """
+    from ..interfaces.oracle import OracleQuery
+
+    if not re.match(r'^[A-Za-z][A-Za-z0-9_$#]*$', watermark_column):
+        raise ValueError('Invalid watermark column: %s' % watermark_column)
+
+    query = OracleQuery()
+    query.inputs.username = username
+    query.inputs.password = password
+    query.inputs.host = host
+    query.inputs.service = service
+    query.inputs.write_to_file = False
+    sql = ("select SUBJECTKEY, SCAN_TYPE, DERIVED_FILES, %s from FMRIRESULTS01 "
+           "where SCAN_TYPE in (%s)" % (watermark_column,
+                                        ', '.join("'%s'" % t for t in SCAN_TYPES)))
+    watermark = manifest.get_watermark(watermark_column) if incremental else None
+    if watermark is not None:
+        sql += ' and %s > :watermark' % watermark_column
+        query.inputs.parameters = {'watermark': watermark}
+        LOGGER.info('Fetching FMRIRESULTS01 rows with %s > %s', watermark_column, watermark)
+    elif incremental:
+        LOGGER.info('No %s high-water mark in %s yet, running a full sync', watermark_column,
+                    manifest.path)
+    query.inputs.query = sql
+    query.run()
+    if 'out' not in query._results:
+        raise RuntimeError('Could not query FMRIRESULTS01')
+
+    result = query._results['out']
+    n_rows = 0
+    if watermark is None:
+        n_rows = manifest.replace(result[[0, 1, 2]].itertuples(index=False, name=None)
+                                  if len(result) else [])
+    elif len(result):
+        n_rows = manifest.upsert(result[[0, 1, 2]].itertuples(index=False, name=None))
+    if len(result):
+        latest = result[3].max()
+        manifest.set_watermark(latest.item() if hasattr(latest, 'item') else latest,
+                               watermark_column)
+    LOGGER.info('Indexed %d FMRIRESULTS01 rows in %s', n_rows, manifest.path)
+
+    if s3_client is not None:
+        update_object_info(manifest, s3_client, n_procs=n_procs)
+    return n_rows
+
+
+def update_object_info(manifest, s3_client, n_procs=8):
+    """HEAD every object without a recorded size/ETag and store both in ``manifest``"""
+    from .download import head_object
+
+    urls = manifest.missing_object_info()
+    if not urls:
+        return {}
+    with ThreadPoolExecutor(max_workers=n_procs) as executor:
+        futures = [executor.submit(head_object, s3_client, url) for url in urls]
+
+    info = {}
+    for url, future in zip(urls, futures):
+        try:
+            info[url] = future.result()
+        except Exception as e:
+            LOGGER.warning('Could not HEAD %s: %s', url, e)
+    manifest.set_object_info(info)
+    LOGGER.info('Recorded size/ETag of %d objects', len(info))
+    return info
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Cached, auto-refreshed NDA AWS credentials
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+TOKEN_URL = 'https://nda.nih.gov/DataManager/dataManager'
+# matches botocore's advisory refresh window so refreshed credentials are always accepted
+REFRESH_MARGIN = 15 * 60
+# assumed lifetime when the token service does not report an expiration
+DEFAULT_LIFETIME = 60 * 60
+
+NDAToken = namedtuple('NDAToken', ['access_key', 'secret_key', 'session_token', 'expiration'])
+
+
+class NDATokenProvider(object):
+    """
+    Hands out NDA AWS credentials, generating new ones only when the cached ones are within
+    ``refresh_margin`` seconds of expiring. Credentials are kept in ``cache_file`` under an
+    exclusive file lock so that all concurrent runs on a node share a single token.
+    ``generator(username, password)`` must return an :class:`NDAToken`.
+    """
+
+    def __init__(self, username, password, cache_file=None, refresh_margin=REFRESH_MARGIN,
+                 generator=None):
+        self.username = username
+        self.password = password
+        if cache_file is None:
+            user_hash = hashlib.sha256(username.encode()).hexdigest()[:16]
+            cache_file = (Path.home() / '.cache' / 'uchicagoABCDProcessing' /
+                          ('nda_token_%s.json' % user_hash))
+        self.cache_file = Path(cache_file)
+        self.refresh_margin = refresh_margin
+        self.generator = generator or default_token_generator
+        self._token = None
+
+    def get(self):
+        """Return valid credentials, refreshing them if they are about to lapse"""
+        if self._is_fresh(self._token):
+            return self._token
+
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with _locked(self.cache_file.with_name(self.cache_file.name + '.lock')):
+            token = self._read()
+            if not self._is_fresh(token):
+                LOGGER.info('Generating a new NDA token for %s', self.username)
+                token = self.generator(self.username, self.password)
+                self._write(token)
+        self._token = token
+        return token
+
+    def metadata(self):
+        """Credentials in the format expected by ``botocore.credentials.RefreshableCredentials``"""
+        token = self.get()
+        return {
+            'access_key': token.access_key,
+            'secret_key': token.secret_key,
+            'token': token.session_token,
+            'expiry_time': datetime.fromtimestamp(token.expiration, timezone.utc).isoformat(),
+        }
+
+    def _is_fresh(self, token):
+        return token is not None and token.expiration - time.time() > self.refresh_margin
+
+    def _read(self):
+        try:
+            cached = json.loads(self.cache_file.read_text())
+        except (OSError, ValueError):
+            return None
+        if cached.get('username') != self.username:
+            return None
+        try:
+            return NDAToken(*(cached[field] for field in NDAToken._fields))
+        except KeyError:
+            return None
+
+    def _write(self, token):
+        cached = dict(token._asdict(), username=self.username)
+        tmp = self.cache_file.with_name(self.cache_file.name + '.tmp')
+        # the secret key and session token must not be readable by other users
+        fd = os.open(str(tmp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(cached, fobj)
+        os.replace(str(tmp), str(self.cache_file))
+
+
+def default_token_generator(username, password, url=TOKEN_URL):
+    """
+    Generate a token in-process with the ``nda_aws_token_generator`` package, falling back to
+    ``$NDA_TOKEN_GEN_DIR/curl/generate_token.sh`` when the package is not installed.
+    """
+    try:
+        from nda_aws_token_generator import NDATokenGenerator
+    except ImportError:
+        return script_token_generator(username, password, url)
+
+    token = NDATokenGenerator(url).generate_token(username, password)
+    return NDAToken(token.access_key, token.secret_key, token.session,
+                    _parse_expiration(token.expiration))
+
+
+def script_token_generator(username, password, url=TOKEN_URL):
+    """Generate a token with the curl script shipped with ``nda_aws_token_generator``"""
+    script = os.path.join(os.getenv('NDA_TOKEN_GEN_DIR', ''), 'curl', 'generate_token.sh')
+    output = subprocess.run(['bash', script, username, password, url], check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return parse_token_output(output)
+
+
+def parse_token_output(output):
+    """
+    Parse the ``Key: value`` lines printed by ``generate_token.sh``
+    >>> parse_token_output('Requesting token...\\nAccess Key: a\\nSecret Key: b\\n'
+    ...                    'Session Token: c\\nExpiration: 2020-01-01T00:00:00Z\\n')
+    NDAToken(access_key='a', secret_key='b', session_token='c', expiration=1577836800.0)
+    """
+    fields = {}
+    for line in output.splitlines():
+        if ':' in line:
+            name, value = line.split(':', 1)
+            fields[name.strip().lower()] = value.strip()
+    try:
+        return NDAToken(fields['access key'], fields['secret key'], fields['session token'],
+                        _parse_expiration(fields.get('expiration')))
+    except KeyError:
+        raise RuntimeError('Could not parse the NDA token generator output:\n%s' % output)
+
+
+def _parse_expiration(expiration):
+    if not expiration:
+        return time.time() + DEFAULT_LIFETIME
+    if isinstance(expiration, datetime):
+        return expiration.timestamp()
+    try:
+        parsed = datetime.fromisoformat(str(expiration).replace('Z', '+00:00'))
+    except ValueError:
+        LOGGER.warning('Unknown NDA token expiration format: %s', expiration)
+        return time.time() + DEFAULT_LIFETIME
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+@contextmanager
+def _locked(lock_file):
+    with open(str(lock_file), 'a') as fobj:
+        fcntl.flock(fobj, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fobj, fcntl.LOCK_UN)
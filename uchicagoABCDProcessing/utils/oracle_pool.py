@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Process-wide Oracle session pools
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import atexit
+import os
+import threading
+from contextlib import contextmanager
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_IDLE_TIMEOUT = 300
+
+_POOLS = {}
+_LOCK = threading.Lock()
+
+
+def get_pool(username, password, host, service, pool_size=DEFAULT_POOL_SIZE,
+             idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """
+    Return the session pool of ``username@host/service``, creating it on first use. Sessions
+    idle for more than ``idle_timeout`` seconds are closed. Pools are never shared with forked
+    children, which get their own.
+    """
+    import cx_Oracle
+
+    key = (os.getpid(), host, service, username)
+    with _LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = cx_Oracle.SessionPool(user=username, password=password,
+                                         dsn='%s/%s' % (host, service),
+                                         min=1, max=pool_size, increment=1, threaded=True,
+                                         getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT,
+                                         timeout=idle_timeout)
+            LOGGER.debug('Opened a pool of up to %d sessions to %s/%s', pool_size, host, service)
+            _POOLS[key] = pool
+    return pool
+
+
+@contextmanager
+def pooled_connection(username, password, host, service, pool_size=DEFAULT_POOL_SIZE,
+                      idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Borrow a connection from the matching pool and give it back afterwards"""
+    pool = get_pool(username, password, host, service, pool_size, idle_timeout)
+    connection = pool.acquire()
+    try:
+        yield connection
+    finally:
+        pool.release(connection)
+
+
+def close_pools():
+    """Close all the pools of this process, called automatically at exit"""
+    with _LOCK:
+        for key in [key for key in _POOLS if key[0] == os.getpid()]:
+            try:
+                _POOLS.pop(key).close(force=True)
+            except Exception as e:
+                LOGGER.warning('Could not close Oracle session pool %s/%s: %s', key[1], key[2], e)
+
+
+atexit.register(close_pools)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Background staging of upcoming participants
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import threading
+from collections import deque
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+
+class PrefetchQueue(object):
+    """
+    Hand out ``items`` in batches while a background thread runs ``stage(item)`` on the items
+    ahead of the batch being consumed. ``stage`` returns the number of bytes it put on disk.
+
+    At most ``max_items`` items are staged ahead of the consumer, and no new item is started
+    while the staged items, including the batch being consumed, hold ``max_bytes`` or more. The
+    bytes of a batch are released when the consumer asks for the next batch. Items whose staging
+    raised are logged, skipped and listed in :attr:`failed` with their error.
+
+    >>> def stage(item):
+    ...     if item == 'b':
+    ...         raise IOError('no space left')
+    ...     return 10
+    >>> queue = PrefetchQueue(stage, ['a', 'b', 'c', 'd'])
+    >>> list(queue.batches(2))
+    [['a', 'c'], ['d']]
+    >>> [item for item, error in queue.failed]
+    ['b']
+    """
+
+    def __init__(self, stage, items, max_items=1, max_bytes=None, stalled=None,
+                 poll_interval=1.0):
+        self._stage = stage
+        self._items = list(items)
+        self._max_items = max(1, max_items)
+        self._max_bytes = max_bytes
+        # e.g. DiskAdmission.holding: staging waits on something only the consumer can release
+        self._stalled = stalled
+        self._poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._staged = deque()
+        self._ahead = 0
+        self._held_bytes = 0
+        self._waiting_room = False
+        self._closed = False
+        self.failed = []
+        self._thread = threading.Thread(target=self._produce, name='prefetch', daemon=True)
+        self._thread.start()
+
+    def batches(self, size=1):
+        """
+        Yield lists of up to ``size`` staged items. A batch is handed out before it is full
+        when no more item can be staged until it is processed: the bytes of the queue are used
+        up, or ``stalled()`` is true (a disk admission waits for the batch to complete).
+        """
+        size = max(1, size)
+        remaining = len(self._items)
+        batch = []
+        batch_bytes = 0
+        try:
+            while remaining:
+                with self._cond:
+                    while not self._staged and not (batch and self._stuck()):
+                        self._cond.wait(self._poll_interval if batch else None)
+                    entry = self._staged.popleft() if self._staged else None
+                    if entry is not None:
+                        self._ahead -= 1
+                        self._cond.notify_all()
+                if entry is not None:
+                    remaining -= 1
+                    item, nbytes, error = entry
+                    if error is not None:
+                        LOGGER.error('Skipping %s, it could not be staged: %s', item, error)
+                        self.failed.append((item, error))
+                    else:
+                        batch.append(item)
+                        batch_bytes += nbytes
+                    if len(batch) < size and remaining:
+                        continue
+                if batch:
+                    yield list(batch)
+                    with self._cond:
+                        # the batch has been processed, its data is no longer needed
+                        self._held_bytes -= batch_bytes
+                        self._cond.notify_all()
+                    batch = []
+                    batch_bytes = 0
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop staging new items, the one being staged (if any) is still completed"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _produce(self):
+        for item in self._items:
+            with self._cond:
+                while not self._closed and not self._has_room():
+                    self._waiting_room = True
+                    self._cond.notify_all()
+                    self._cond.wait()
+                self._waiting_room = False
+                if self._closed:
+                    return
+                self._ahead += 1
+
+            LOGGER.info('Staging %s', item)
+            nbytes = 0
+            error = None
+            try:
+                nbytes = self._stage(item) or 0
+            except Exception as e:
+                LOGGER.error('Staging %s failed: %s', item, e)
+                error = e
+
+            with self._cond:
+                self._held_bytes += nbytes
+                self._staged.append((item, nbytes, error))
+                self._cond.notify_all()
+
+    def _stuck(self):
+        if self._waiting_room and not self._has_room():
+            return True
+        return self._stalled is not None and self._stalled()
+
+    def _has_room(self):
+        if self._ahead >= self._max_items:
+            return False
+        return self._max_bytes is None or self._held_bytes < self._max_bytes
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+On-disk cache of database query results
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import hashlib
+import json
+import os
+import pickle
+import re
+import time
+import uuid
+from pathlib import Path
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+DEFAULT_TTL = 24 * 60 * 60
+
+# string literals and quoted identifiers, quotes inside them are doubled
+QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def normalize_sql(query):
+    """
+    Collapse whitespace outside of quotes and drop a trailing semicolon so equivalent queries
+    share a key
+    >>> normalize_sql('select *\\n  from FMRIRESULTS01 ;')
+    'select * from FMRIRESULTS01'
+    >>> normalize_sql("select * from T where A = 'x  y'")
+    "select * from T where A = 'x  y'"
+    """
+    parts = QUOTED.split(query)
+    # the parts at even indices are outside of quotes
+    parts[::2] = [re.sub(r'\s+', ' ', part) for part in parts[::2]]
+    parts[-1] = parts[-1].rstrip().rstrip(';')
+    return ''.join(parts).strip()
+
+
+class QueryCache(object):
+    """
+    Query results pickled under ``root``, keyed on the normalized SQL, the bind values and the
+    identity (host, service, user) of the database. Every entry carries its own expiry.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(query, parameters, host, service, username):
+        if isinstance(parameters, dict):
+            parameters = sorted(parameters.items())
+        identity = [normalize_sql(query), parameters or [], host, service, username]
+        return hashlib.sha256(json.dumps(identity, default=str).encode()).hexdigest()
+
+    def _path(self, key):
+        return self.root / ('%s.pkl' % key)
+
+    def get(self, key):
+        """The cached result, or None when it is missing or expired"""
+        path = self._path(key)
+        try:
+            with path.open('rb') as fobj:
+                expires, result = pickle.load(fobj)
+        except FileNotFoundError:
+            return None
+        except Exception as e:  # truncated, pickled by other pandas/python versions, ...
+            LOGGER.warning('Ignoring unusable cached query result %s: %s', path, e)
+            return None
+        if expires < time.time():
+            self.invalidate(key)
+            return None
+        return result
+
+    def put(self, key, result, ttl=DEFAULT_TTL):
+        path = self._path(key)
+        tmp = path.with_name('%s.%s.tmp' % (path.name, uuid.uuid4().hex))
+        with tmp.open('wb') as fobj:
+            pickle.dump((time.time() + ttl, result), fobj, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(tmp), str(path))
+
+    def invalidate(self, key=None):
+        """Drop the entry ``key``, or every entry when no key is given"""
+        paths = [self._path(key)] if key is not None else list(self.root.glob('*.pkl'))
+        for path in paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        return len(paths)
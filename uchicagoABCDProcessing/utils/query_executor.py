@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Concurrent, rate limited miNDAR queries
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueryExecutor(object):
+    """
+    Run independent :class:`..interfaces.oracle.OracleQuery` lookups on a pool of
+    ``max_workers`` threads, each borrowing a session from the same process-wide pool. At most
+    ``max_workers`` queries are in flight and, when ``max_rate`` is given, no more than
+    ``max_rate`` queries start per second, so the RDS instance is not overloaded. Results are
+    returned in submission order.
+    """
+
+    def __init__(self, username, password, host, service='ORCL', max_workers=4, max_rate=None,
+                 cache_dir=None, cache_ttl=None):
+        self.connection = {'username': username, 'password': password, 'host': host,
+                           'service': service}
+        self.max_workers = max_workers
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self._limiter = _RateLimiter(max_rate)
+
+    def imap(self, queries):
+        """
+        Yield the result of each query in order, ``queries`` holds sql strings or
+        ``(sql, bind variables)`` pairs
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._run, query) for query in queries]
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def map(self, queries):
+        return list(self.imap(queries))
+
+    def _run(self, query):
+        from ..interfaces.oracle import OracleQuery
+
+        sql, parameters = (query, None) if isinstance(query, str) else query
+        interface = OracleQuery(pool_size=self.max_workers, write_to_file=False,
+                                **self.connection)
+        interface.inputs.query = sql
+        if parameters is not None:
+            interface.inputs.parameters = parameters
+        if self.cache_dir is not None:
+            interface.inputs.cache_dir = str(self.cache_dir)
+            if self.cache_ttl is not None:
+                interface.inputs.cache_ttl = self.cache_ttl
+
+        self._limiter.wait()
+        interface.run()
+        if 'out' not in interface._results:
+            raise RuntimeError('Query failed: %s' % sql)
+        return interface._results['out']
+
+
+class _RateLimiter(object):
+    """Space out calls to :meth:`wait` so at most ``max_rate`` return per second"""
+
+    def __init__(self, max_rate=None):
+        self._interval = 1.0 / max_rate if max_rate else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        time.sleep(max(0, start - now))
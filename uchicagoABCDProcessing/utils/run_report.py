@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Throughput report of a participant's run
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import json
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class RunReport(object):
+    """
+    Wall time and bytes of every stage (download, extraction, defacing, validation, workflow
+    build and run) of a participant, plus one record per object (S3 archive, defaced image).
+    Safe to update from several threads.
+
+    >>> report = RunReport('NDAR_INVA')
+    >>> report.add('download', seconds=2.0, nbytes=4 * 1024 ** 2)
+    >>> report.to_dict()['stages']['download']['MB/s']
+    2.0
+    """
+
+    def __init__(self, participant):
+        self.participant = participant
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.objects = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        """Add the wall time of the ``with`` block to ``stage``"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, seconds=time.time() - start)
+
+    def add(self, stage, seconds=0.0, nbytes=0, count=0):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {'seconds': 0.0, 'bytes': 0, 'count': 0})
+            totals['seconds'] += seconds
+            totals['bytes'] += nbytes
+            totals['count'] += count
+
+    def merge(self, other):
+        """Add the stages and objects of ``other`` (e.g. the staging of one participant)"""
+        for stage, totals in other.stages.items():
+            self.add(stage, totals['seconds'], totals['bytes'], totals['count'])
+        with self._lock:
+            self.objects.extend(other.objects)
+        self.started = min(self.started, other.started)
+
+    def record(self, stage, name, seconds, nbytes=None, **extra):
+        """Record the handling of a single object (an archive, an image) during ``stage``"""
+        entry = OrderedDict([('stage', stage), ('name', str(name)), ('seconds', seconds)])
+        if nbytes is not None:
+            entry['bytes'] = nbytes
+            entry['MB/s'] = _throughput(nbytes, seconds)
+        entry.update(extra)
+        with self._lock:
+            self.objects.append(entry)
+
+    def to_dict(self):
+        with self._lock:
+            stages = OrderedDict()
+            for stage, totals in self.stages.items():
+                stages[stage] = dict(totals, **{'MB/s': _throughput(totals['bytes'],
+                                                                    totals['seconds'])})
+            return OrderedDict([('participant', self.participant),
+                                ('host', socket.gethostname()),
+                                ('started', time.strftime('%Y-%m-%dT%H:%M:%S',
+                                                          time.localtime(self.started))),
+                                ('seconds', time.time() - self.started),
+                                ('stages', stages),
+                                ('objects', list(self.objects))])
+
+    def write(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_dict(), indent=2))
+        return path
+
+
+def _throughput(nbytes, seconds):
+    if not nbytes or seconds <= 0:
+        return None
+    return round(nbytes / 1024 ** 2 / seconds, 3)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Node-local scratch directories
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.utils')
+
+
+@contextmanager
+def scratch_dir(root, prefix='uchicagoABCDProcessing-'):
+    """A private directory under ``root``, removed on exit whether or not the body failed"""
+    Path(root).mkdir(parents=True, exist_ok=True)
+    path = Path(tempfile.mkdtemp(prefix=prefix, dir=str(root)))
+    try:
+        yield path
+    finally:
+        shutil.rmtree(str(path), ignore_errors=True)
+        LOGGER.debug('Removed scratch directory %s', path)
+
+
+def copy_tree(src, dst):
+    """
+    Copy the files under ``src`` into ``dst`` in one pass, merging with what ``dst`` already
+    holds. Returns the number of bytes copied.
+    """
+    src = Path(src)
+    if not src.exists():
+        return 0
+    if src.is_file():
+        Path(dst).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(str(src), str(dst))
+        return src.stat().st_size
+
+    start = time.time()
+    n_bytes = 0
+    for root, _, files in os.walk(str(src)):
+        target = Path(dst) / os.path.relpath(root, str(src))
+        target.mkdir(parents=True, exist_ok=True)
+        for name in files:
+            shutil.copy2(os.path.join(root, name), str(target / name))
+            n_bytes += os.path.getsize(os.path.join(root, name))
+    LOGGER.info('Copied %.1f MB from %s to %s in %.1f s', n_bytes / 1024 ** 2, src, dst,
+                time.time() - start)
+    return n_bytes
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Persistent cache of built workflows
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import uuid
+from importlib import import_module
+from pathlib import Path
+
+from nipype import logging
+
+from .deface import file_sha256
+
+LOGGER = logging.getLogger('nipype.workflow')
+
+# packages whose version changes the graph init_base_wf builds
+PACKAGES = ('fmriprep', 'smriprep', 'niworkflows', 'nipype', 'atlasTransform',
+            'enlNipypeInterfaces', 'fMRIConfoundRegression', 'neuroHurst')
+# modules of this package building the graph, their source is part of the key
+MODULES = ('uchicagoABCDProcessing.workflows.base', 'uchicagoABCDProcessing.workflows.datasink')
+# directories baked into the graph that change from run to run (--scratch_dir runs in a new
+# directory every time): they are left out of the key and the cached graph is rebased on them
+ROOTS = ('bids_dir', 'work_dir', 'output_dir', 'cold_output_dir')
+# options that do not change the graph
+IGNORED_OPTIONS = ROOTS + ('scratch_dir', 'workflow_cache_dir', 'no_workflow_cache')
+
+
+def workflow_cache_key(opts, bids_dir, subject_list, cache_dir=None):
+    """
+    Hash of everything the built workflow depends on: the parsed options (but the directories
+    in :data:`ROOTS`), the versions of the packages involved, the source of the workflow
+    modules and the files (relative path, size and sha256) of the subjects in the BIDS tree.
+    The sha256 of unchanged files (same size and modification time) are reused from
+    ``cache_dir``.
+    """
+    from ..__about__ import __version__
+
+    sha = hashlib.sha256()
+    options = sorted((name, value) for name, value in vars(opts).items()
+                     if name not in IGNORED_OPTIONS)
+    sha.update(json.dumps(options, default=str).encode())
+
+    versions = [('uchicagoABCDProcessing', __version__)]
+    for package in PACKAGES:
+        try:
+            versions.append((package, getattr(import_module(package), '__version__', None)))
+        except ImportError:
+            versions.append((package, None))
+    sha.update(json.dumps(versions).encode())
+
+    for module in MODULES:
+        sha.update(Path(import_module(module).__file__).read_bytes())
+
+    bids_dir = Path(bids_dir)
+    files = [path for path in sorted(bids_dir.iterdir()) if path.is_file()]
+    for subject in sorted(subject_list):
+        subject_dir = bids_dir / ('sub-%s' % subject)
+        for root, dirs, names in os.walk(str(subject_dir)):
+            dirs.sort()
+            files.extend(Path(root) / name for name in sorted(names))
+    hashes = _FileHashes(cache_dir)
+    listing = [(str(path.relative_to(bids_dir)), path.stat().st_size, hashes.get(path, bids_dir))
+               for path in files]
+    hashes.save()
+    sha.update(json.dumps(listing).encode())
+    return sha.hexdigest()
+
+
+def workflow_roots(opts):
+    """The directories of :data:`ROOTS` the workflow of ``opts`` is built on"""
+    return {name: str(Path(getattr(opts, name)).resolve()) for name in ROOTS
+            if getattr(opts, name, None) is not None}
+
+
+def load_workflow(cache_dir, key, roots=None, run_uuid=None):
+    """
+    Workflow saved under ``key``, or None. The paths under the directories the workflow was
+    built on are moved to the matching directories of ``roots``, and the identifier of the run
+    it was built for is replaced by ``run_uuid``.
+    """
+    path = Path(cache_dir) / ('%s.pkl' % key)
+    try:
+        with path.open('rb') as fobj:
+            built_uuid, built_roots, workflow = pickle.load(fobj)
+        if roots:
+            rebase_workflow(workflow, [(built_roots[name], roots[name]) for name in roots
+                                       if name in built_roots])
+        if run_uuid is not None and run_uuid != built_uuid:
+            # in the log and report paths and the inputs naming the run
+            _map_workflow(workflow, lambda value: value.replace(built_uuid, run_uuid))
+        return workflow
+    except FileNotFoundError:
+        return None
+    except Exception as e:  # written by incompatible package versions, truncated, ...
+        LOGGER.warning('Ignoring unusable cached workflow %s: %s', path, e)
+        return None
+
+
+def save_workflow(cache_dir, key, run_uuid, workflow, roots=None):
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path = cache_dir / ('%s.pkl' % key)
+    tmp = path.with_name('%s.%s.tmp' % (path.name, uuid.uuid4().hex))
+    with tmp.open('wb') as fobj:
+        pickle.dump((run_uuid, roots or {}, workflow), fobj, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(str(tmp), str(path))
+    return path
+
+
+def rebase_workflow(workflow, moves):
+    """
+    Rewrite the base directory of ``workflow`` and every input and iterable of its nodes that
+    lies under one of the ``(old, new)`` directories of ``moves``
+    """
+    # the deepest directories first, bids_dir is usually inside work_dir
+    moves = sorted(((old, new) for old, new in moves if old != new),
+                   key=lambda move: len(move[0]), reverse=True)
+    if not moves:
+        return workflow
+
+    def _rebase(value):
+        for old, new in moves:
+            if value == old or value.startswith(old + os.sep):
+                return new + value[len(old):]
+        return value
+
+    return _map_workflow(workflow, _rebase)
+
+
+def _map_workflow(workflow, func):
+    """Apply ``func`` to the base directory and every string in the inputs and iterables"""
+    if workflow.base_dir is not None:
+        workflow.base_dir = func(workflow.base_dir)
+    for node in workflow._get_all_nodes():
+        for name, value in node.inputs.get().items():
+            mapped = _map_strings(value, func)
+            if mapped != value:
+                setattr(node.inputs, name, mapped)
+        if node.iterables:
+            node.iterables = _map_strings(node.iterables, func)
+    return workflow
+
+
+def _map_strings(value, func):
+    if isinstance(value, str):
+        return func(value)
+    if isinstance(value, list):
+        return [_map_strings(item, func) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_map_strings(item, func) for item in value)
+    if isinstance(value, dict):
+        return {key: _map_strings(item, func) for key, item in value.items()}
+    return value
+
+
+class _FileHashes(object):
+    """sha256 of the BIDS files, recomputed only for files whose size or mtime changed"""
+
+    def __init__(self, cache_dir=None):
+        self._path = None if cache_dir is None else Path(cache_dir) / 'file_hashes.json'
+        self._hashes = {}
+        if self._path is not None and self._path.exists():
+            try:
+                self._hashes = json.loads(self._path.read_text())
+            except ValueError:
+                pass
+        self._changed = False
+
+    def get(self, path, root):
+        stat = path.stat()
+        name = str(path.relative_to(root))
+        entry = self._hashes.get(name)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            entry = [stat.st_size, stat.st_mtime_ns, file_sha256(path)]
+            self._hashes[name] = entry
+            self._changed = True
+        return entry[2]
+
+    def save(self):
+        if self._path is None or not self._changed:
+            return
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=str(self._path.parent),
+                                         prefix=self._path.name, suffix='.tmp',
+                                         delete=False) as tmp:
+            tmp.write(json.dumps(self._hashes))
+        os.replace(tmp.name, str(self._path))
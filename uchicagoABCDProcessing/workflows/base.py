@@ -1,6 +1,5 @@
 from argparse import ArgumentParser
 
-import numpy
 from atlasTransform.interfaces import AtlasTransform
 from enlNipypeInterfaces.interfaces import FisherRToZMatrix
 from fMRIConfoundRegression.interfaces import ThirtySixParameter
@@ -11,6 +10,9 @@ from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu, afni
 
 from uchicagoABCDProcessing.interfaces import Motion
+from uchicagoABCDProcessing.interfaces.parcellation import MultiAtlasTimeSeries, find_atlas, \
+    parcellation_mem_gb
+from uchicagoABCDProcessing.interfaces.postprocessing import FusedPostprocessing
 from uchicagoABCDProcessing.interfaces.trim_time_series import Trim
 from uchicagoABCDProcessing.workflows.datasink import DEFAULT_MEMORY_MIN_GB, init_regressed_datasink_wf, \
     init_derivatives_datasink_wf
@@ -94,39 +96,42 @@ def init_base_wf(
     """
 
 
-    # list of func preproc workflows
-    all_func_workflows = list(filter(lambda node_name: node_name.__contains__("func_preproc"), fmriprep_workflow.list_node_names()))
-    unique_ses_task_func_workflows = numpy.unique(list(map(lambda wf_name: wf_name.split('.')[1], all_func_workflows)))
-    workflow_base_name = all_func_workflows[0].split('.')[0]  ## making a big assumption that this is only being run for one subject at a time
+    # index every node and sub-workflow by its dotted name once, instead of walking the graph on each lookup
+    nodes = _index_nodes(fmriprep_workflow)
 
-    for unique_workflow in unique_ses_task_func_workflows:
+    # list of func preproc workflows of every subject, as (single_subject_*_wf, func_preproc_*_wf) pairs
+    unique_ses_task_func_workflows = sorted(
+        tuple(node_name.split('.')) for node_name in nodes
+        if node_name.count('.') == 1 and node_name.split('.')[1].__contains__("func_preproc"))
+
+    for workflow_base_name, unique_workflow in unique_ses_task_func_workflows:
         # collect all the nodes that we need to disconnect hmc (head motion correction) and bold_bold_trans (bold realignment) workflows
-        wf = fmriprep_workflow.get_node(workflow_base_name + '.' + unique_workflow)
-        bold_hmc_wf = fmriprep_workflow.get_node(
+        wf = nodes.get(workflow_base_name + '.' + unique_workflow)
+        bold_hmc_wf = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_hmc_wf')
-        bold_confounds_wf = fmriprep_workflow.get_node(
+        bold_confounds_wf = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_confounds_wf')
-        bold_bold_trans_wf = fmriprep_workflow.get_node(
+        bold_bold_trans_wf = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_bold_trans_wf')
 
-        bold_t1_trans_wf = fmriprep_workflow.get_node(
+        bold_t1_trans_wf = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_t1_trans_wf')
-        bold_t1_trans_wf_merge_xforms_node = fmriprep_workflow.get_node(
+        bold_t1_trans_wf_merge_xforms_node = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_t1_trans_wf' + '.' + 'merge_xforms')
-        bold_t1_trans_wf_bold_to_t1w_transform_node = fmriprep_workflow.get_node(
+        bold_t1_trans_wf_bold_to_t1w_transform_node = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_t1_trans_wf' + '.' + 'bold_to_t1w_transform')
-        bold_t1_trans_wf_inputnode = fmriprep_workflow.get_node(
+        bold_t1_trans_wf_inputnode = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_t1_trans_wf' + '.' + 'inputnode')
 
-        bold_std_trans_wf = fmriprep_workflow.get_node(
+        bold_std_trans_wf = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_std_trans_wf')
-        bold_std_trans_wf_merge_xforms_node = fmriprep_workflow.get_node(
+        bold_std_trans_wf_merge_xforms_node = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_std_trans_wf' + '.' + 'merge_xforms')
-        bold_std_trans_wf_bold_to_std_transform_node = fmriprep_workflow.get_node(
+        bold_std_trans_wf_bold_to_std_transform_node = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_std_trans_wf' + '.' + 'bold_to_std_transform')
-        bold_std_trans_wf_inputnode = fmriprep_workflow.get_node(
+        bold_std_trans_wf_inputnode = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_std_trans_wf' + '.' + 'inputnode')
-        bold_std_trans_wf_select_std = fmriprep_workflow.get_node(
+        bold_std_trans_wf_select_std = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'bold_std_trans_wf' + '.' + 'select_std')
 
         wf.remove_nodes([bold_hmc_wf])  # disconnect hmc workflow
@@ -155,12 +160,11 @@ def init_base_wf(
         ])
 
         # collect some more nodes necessary for removing the bold bold trans (realignment) workflow
-        bold_sdc_wf = fmriprep_workflow.get_node(
+        bold_sdc_wf = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'sdc_bypass_wf')
-        carpetplot_wf = fmriprep_workflow.get_node(
+        carpetplot_wf = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'carpetplot_wf')
-        print(wf.list_node_names())
-        inputnode = fmriprep_workflow.get_node(
+        inputnode = nodes.get(
             workflow_base_name + '.' + unique_workflow + '.' + 'inputnode')
 
         # remove the realignment workflow
@@ -230,56 +234,102 @@ def init_base_wf(
             (inputnode, rg_workflow, [(('bold_file',_pop), 'inputnode.source_file')]),
         ])
 
-        # do each parcellation and final processing seperately
-        for parcellation in opts.parcellations:
-            parcellation_name, number_of_clusters = parcellation.split('_') # e.g. parcellation='craddock_400'
-            transformNode = pe.Node(AtlasTransform(), name='transform_%s' % parcellation) #output is transformed
-
-            # setup the inputs for the parcellation node
-            transformNode.inputs.atlas_name = parcellation_name
-            transformNode.inputs.resolution = opts.resolution
-            transformNode.inputs.number_of_clusters = int(number_of_clusters)
-            transformNode.inputs.similarity_measure = opts.similarity_measure
-            transformNode.inputs.algorithm = opts.algorithm
-            transformNode.inputs.bids_dir = layout.root
-
-            # connectup the parcellation node
-            wf.connect([
-                (merge_deconfounded, transformNode,[('out', 'nifti')])
-            ])
-
-            # now trim the parcelated time series
-            trimNode = pe.Node(Trim(), name='trim_%s' % parcellation)
-            wf.connect([
-                (transformNode, trimNode, [('transformed', 'ts')])
-            ])
-
-            ## now connect parcellation output to hurst and connectivity
-            connectivityNode = pe.Node(FisherRToZMatrix(), name='connectivity_%s' % parcellation, itersource=merge_deconfounded.name) #input is csv output is connectivity
-            wf.connect([
-                (trimNode, connectivityNode, [('trimmed', 'csv')])
-            ])
-
-            hurstNode = pe.Node(DFA(), name='dfa_%s' % parcellation, itersource=merge_deconfounded.name)
+        if opts.atlas_dir is not None:
+            # label images are given: one node loads the despiked bold once for all the atlases
+            atlases = [find_atlas(opts.atlas_dir, parcellation) for parcellation in opts.parcellations]
+            parcellationNode = pe.Node(MultiAtlasTimeSeries(), name='parcellate',
+                                       mem_gb=parcellation_mem_gb(_pop(inputnode.inputs.bold_file),
+                                                                  atlases)) #output is time_series
+            parcellationNode.inputs.atlases = atlases
+            parcellationNode.inputs.atlas_names = list(opts.parcellations)
             wf.connect([
-                (trimNode, hurstNode, [('trimmed', 'csv')]),
-                (merge_deconfounded, hurstNode, [('out', 'bold')])
+                (merge_deconfounded, parcellationNode, [(('out', _pop), 'bold')])
             ])
 
+        # do each parcellation and final processing seperately
+        for parcellation_index, parcellation in enumerate(opts.parcellations):
+            if opts.fused_postproc:
+                # trim, connectivity and dfa in a single node
+                trimNode = pe.Node(FusedPostprocessing(), name='postproc_%s' % parcellation,
+                                   itersource=merge_deconfounded.name)
+                wf.connect([
+                    (merge_deconfounded, trimNode, [('out', 'bold')])
+                ])
+            else:
+                # now trim the parcelated time series
+                trimNode = pe.Node(Trim(), name='trim_%s' % parcellation)
+
+            if opts.atlas_dir is not None:
+                wf.connect([
+                    (parcellationNode, trimNode, [(('time_series', _select, parcellation_index), 'ts')])
+                ])
+            else:
+                parcellation_name, number_of_clusters = parcellation.split('_') # e.g. parcellation='craddock_400'
+                transformNode = pe.Node(AtlasTransform(), name='transform_%s' % parcellation) #output is transformed
+
+                # setup the inputs for the parcellation node
+                transformNode.inputs.atlas_name = parcellation_name
+                transformNode.inputs.resolution = opts.resolution
+                transformNode.inputs.number_of_clusters = int(number_of_clusters)
+                transformNode.inputs.similarity_measure = opts.similarity_measure
+                transformNode.inputs.algorithm = opts.algorithm
+                transformNode.inputs.bids_dir = layout.root
+
+                # connectup the parcellation node
+                wf.connect([
+                    (merge_deconfounded, transformNode,[('out', 'nifti')])
+                ])
+                wf.connect([
+                    (transformNode, trimNode, [('transformed', 'ts')])
+                ])
 
             derivates_output_wf = init_derivatives_datasink_wf(str(opts.output_dir), atlas=parcellation, name='output_%s_wf' % parcellation)
-
             wf.connect([
                 (rg_workflow, derivates_output_wf, [(('ds_regressed.out_file',_pop), 'inputnode.despiked')]),
-                (trimNode, derivates_output_wf, [(('transformed', _pop2),'inputnode.transformed')]),
-                (hurstNode, derivates_output_wf, [(('hurst',_pop), 'inputnode.hurst')]),
-                (hurstNode, derivates_output_wf, [(('confidence_intervals',_pop), 'inputnode.hurst_ci')]),
-                (hurstNode, derivates_output_wf, [(('rsquared',_pop), 'inputnode.hurst_r2')]),
-                (connectivityNode, derivates_output_wf, [(('connectivity',_pop), 'inputnode.connectivity')]),
             ])
 
+            if opts.fused_postproc:
+                wf.connect([
+                    (trimNode, derivates_output_wf, [('trimmed', 'inputnode.transformed'),
+                                                     (('hurst', _pop), 'inputnode.hurst'),
+                                                     (('confidence_intervals', _pop), 'inputnode.hurst_ci'),
+                                                     (('rsquared', _pop), 'inputnode.hurst_r2'),
+                                                     (('connectivity', _pop), 'inputnode.connectivity')]),
+                ])
+            else:
+                ## now connect parcellation output to hurst and connectivity
+                connectivityNode = pe.Node(FisherRToZMatrix(), name='connectivity_%s' % parcellation, itersource=merge_deconfounded.name) #input is csv output is connectivity
+                wf.connect([
+                    (trimNode, connectivityNode, [('trimmed', 'csv')])
+                ])
+
+                hurstNode = pe.Node(DFA(), name='dfa_%s' % parcellation, itersource=merge_deconfounded.name)
+                wf.connect([
+                    (trimNode, hurstNode, [('trimmed', 'csv')]),
+                    (merge_deconfounded, hurstNode, [('out', 'bold')])
+                ])
+
+                wf.connect([
+                    (trimNode, derivates_output_wf, [(('transformed', _pop2),'inputnode.transformed')]),
+                    (hurstNode, derivates_output_wf, [(('hurst',_pop), 'inputnode.hurst')]),
+                    (hurstNode, derivates_output_wf, [(('confidence_intervals',_pop), 'inputnode.hurst_ci')]),
+                    (hurstNode, derivates_output_wf, [(('rsquared',_pop), 'inputnode.hurst_r2')]),
+                    (connectivityNode, derivates_output_wf, [(('connectivity',_pop), 'inputnode.connectivity')]),
+                ])
+
     return fmriprep_workflow
 
+def _index_nodes(workflow, prefix=''):
+    """Map the dotted name of every node and sub-workflow nested in ``workflow`` to the object"""
+    index = {}
+    for node in workflow._graph.nodes():
+        name = prefix + node.name
+        index[name] = node
+        if isinstance(node, pe.Workflow):
+            index.update(_index_nodes(node, name + '.'))
+    return index
+
+
 def _prefix(subid):
     if subid.startswith('sub-'):
         return subid
@@ -291,6 +341,11 @@ def _pop(inlist):
         return inlist[0]
     return inlist
 
+def _select(inlist, index):
+    if isinstance(inlist, (list, tuple)):
+        return inlist[index]
+    return inlist  # OutputMultiObject gives a single item as is
+
 def _pop2(inlist):
     if isinstance(inlist, (list, tuple)):
         return inlist[0][0]